@@ -17,73 +17,232 @@
 #"""
 from array import array
 from math import *
-from io import BytesIO
 import gc
+import imgcache
+
+# output pixel formats
+RGB888 = 0
+RGB565 = 1
+RGB565_LE = 2
+GS8 = 3
+MONO = 4
+
+# bytes read at once while looking for the frame header
+PROBE_SIZE = 512
+
+
+class BlockReader():
+    # reads the source in blocks into one reused bytearray, bytes are taken
+    # from it by index, so reading a byte allocates nothing and the file is
+    # accessed once per block, buffer sources are read in place
+    def __init__(self, source, size=1024, buf=None):
+        # buf - bytearray to read files into instead of a new one of size
+        self.start = 0  # file offset of buf[0]
+        self.pos = 0
+        if isinstance(source, str):
+            self.file = open(source, 'rb')
+            self.buf = bytearray(size) if buf is None else buf
+            self.mv = memoryview(self.buf)
+            self.end = 0
+        else:
+            self.file = None
+            self.buf = self.mv = memoryview(source)
+            self.end = len(self.mv)
+
+    def fill(self):
+        # drops the bytes before pos and reads the rest of the buffer,
+        # returns the number of bytes from pos
+        if not self.file:
+            return self.end - self.pos
+        rest = self.end - self.pos
+        if rest:
+            self.mv[:rest] = self.mv[self.pos:self.end]
+        self.start += self.pos
+        self.pos = 0
+        self.end = rest + (self.file.readinto(self.mv[rest:]) or 0)
+        return self.end
 
-
-def jpeg(source, quality=8, callback=print, cache=False):
+    @micropython.native
+    def byte(self):
+        # -1 at the end of file
+        if self.pos >= self.end and not self.fill():
+            return -1
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    def word(self):
+        return self.byte() << 8 | self.byte()
+
+    def read(self, n):
+        # view of the next n bytes in the buffer, copied only if they don't
+        # fit into it
+        if self.pos + n > self.end and self.file:
+            self.fill()
+        if n > self.end and self.file:
+            out = bytes(self.mv[:self.end]) + self.file.read(n - self.end)
+            self.start += n
+            self.pos = self.end = 0
+            return out
+        self.pos += n
+        return self.mv[self.pos - n:self.pos]
+
+    def tell(self):
+        return self.start + self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2 and not self.file:
+            offset += self.end
+        elif whence == 2:
+            self.file.seek(offset, 2)
+            self.start = self.file.tell()
+            self.pos = self.end = 0
+            return
+        if self.start <= offset <= self.start + self.end or not self.file:
+            self.pos = offset - self.start
+            return
+        self.file.seek(offset)
+        self.start = offset
+        self.pos = self.end = 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def jpeg(source, quality=8, callback=print, cache=False, fastidct=True, scale=1, blockcallback=None, output_format=RGB888, buffer_size=1024, fancy=False, profile=None):
     if quality < 1 or quality > 8:
         raise ValueError('Quality must be between 1 and 8')
-    huffman_ac_tables = [{}, {}, {}, {}]
-    huffman_dc_tables = [{}, {}, {}, {}]
+    if scale not in (1, 2, 4, 8):
+        raise ValueError('Scale must be 1, 2, 4 or 8')
+    if output_format not in (RGB888, RGB565, RGB565_LE, GS8, MONO):
+        raise ValueError('Unknown output format')
+    huffman_ac_tables = [0, 0, 0, 0]
+    huffman_dc_tables = [0, 0, 0, 0]
 
     q_table = [[], [], [], []]
 
     XYP = 0, 0, 0
+    frame_size = 0, 0
+    is_progressive = False
+    progressive = False
+    refine = False
+    scan_ss = 0
+    scan_se = 63
+    scan_ah = 0
+    scan_al = 0
+    scan_comps = []
+    eobrun = 0
+    restart_interval = 0
+    segment = 0
+    segment_list = None
+    segment_offsets = []
+    crop = False
+    view = 0, 0, 0, 0, 0, 0
+    # MCUs between yields of incremental rendering, 0 to never yield
+    step_mcus = 0
     bit_stream = 0
+    bitbuf = 0
+    bitcnt = 0
+    marker = 0
     component = {}
+    comp_index = {}
     num_components = 0
     mcus_read = 0
-    inline_dc = 0
     rx = 0
     ry = 0
 
     idct_precision = quality
+    block = 8 // scale
 
     EOI = False
-    cached = array('i')
-    cachedX = array('B')
-    cachedY = array('B')
-    data = []
-    pint = int
+    cacheimg = None
+    # read buffer of file sources, allocated on the first file
+    readbuf = None
+    cached = bytearray(0)
+    dc_prev = array('h', [0, 0, 0, 0])
+    zero_du = array('h', [0] * 64)
+    workspace = array('i', zero_du)
+    zigzag = array('b', [
+        0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5, 12, 19, 26,
+        33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28, 35, 42, 49, 56, 57,
+        50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51, 58, 59, 52, 45, 38, 31,
+        39, 46, 53, 60, 61, 54, 47, 55, 62, 63
+    ])
 
     offsety = 0
     offsetx = 0
+    blockbuf = bytearray(0)
+    # full resolution MCU samples of every component, mcu_w x mcu_h
+    planes = []
+    chroma = array('h')
+    mcu_w = 0
+    mcu_h = 0
+    ncomp = 0
+    # data units of one MCU, reused for every MCU
+    mcu_pool = []
+    # output colors of one MCU row
+    colors = array('i')
+    # color conversion tables, built on the first decode
+    clip_table = b''
+    cr_r = array('H')
+    cb_b = array('H')
+    cb_g = array('H')
+    cr_g = array('H')
+    # Adobe APP14 color transform, frame components are RGB if 0
+    transform = -1
+    rgb_ids = False
+    pxsize = (3, 2, 2, 1, 1)[output_format]
+    bayer = bytes([8, 136, 40, 168, 200, 72, 232, 104, 56, 184, 24, 152, 248, 120, 216, 88])
 
     idct_table = 0
     range8 = range(8)
     rangeIDCT = range(idct_precision)
+    scaled_table = 0
 
-    @micropython.viper
-    def rgb_to_int(RGBlist) -> int:
-        return (int(RGBlist[0]) << 0x10) + (int(RGBlist[1]) << 0x8) + int(
-            RGBlist[2])
-
-    @micropython.viper
-    def bint(inp) -> int:
-        return int(pint.from_bytes(inp, 'little'))
-
-    @micropython.viper
-    def intb(inp):
-        return bytes([inp])
+    @micropython.native
+    def show_block(x, y, w, h):
+        size = w * h * pxsize
+        if size == len(blockbuf):
+            blockcallback(x, y, w, h, blockbuf)
+        else:
+            blockcallback(x, y, w, h, memoryview(blockbuf)[:size])
 
-    @micropython.viper
-    def read_word(file) -> int:
-        out = int(bint(file.read(1))) << 8
-        out |= int(bint(file.read(1)))
-        return out
+    @micropython.native
+    def read_word(file):
+        return file.word()
 
-    @micropython.viper
+    @micropython.native
     def read_byte(file):
-        out = bint(file.read(1))
-        return out
+        return file.byte()
 
-    @micropython.viper
-    def map_codes_to_values(codes, values):
-        out = {}
-        for i in range(int(len(codes))):
-            out[codes[i]] = values[i]
-        return out
+    @micropython.native
+    def build_huffman_table(huffsize, huffval):
+        # lookup resolves codes up to 9 bits with a single index:
+        # (code length << 8) | value, 0 if the code is longer
+        lookup = array('H', [0] * 512)
+        maxcode = array('i', [-1] * 17)
+        valoff = array('i', [0] * 17)
+        code = 0
+        k = 0
+
+        for l in range(1, 17):
+            n = huffsize[l - 1]
+            if n:
+                valoff[l] = k - code
+                for i in range(n):
+                    if l <= 9:
+                        shift = 9 - l
+                        entry = (l << 8) | huffval[k]
+                        for j in range(code << shift, (code + 1) << shift):
+                            lookup[j] = entry
+                    code += 1
+                    k += 1
+                maxcode[l] = code - 1
+            code <<= 1
+
+        return lookup, maxcode, valoff, huffval
 
     @micropython.viper
     def read_dht(file):
@@ -93,41 +252,23 @@ def jpeg(source, quality=8, callback=print, cache=False):
         Lh = int(read_word(file))
         Lh -= 2
         while Lh > 0:
-            huffsize = []
-            huffval = []
+            huffsize = bytearray(16)
             T = int(read_byte(file))
             Th = T & 0x0F
             Tc = (T >> 4) & 0x0F
             Lh = Lh - 1
 
+            huffsize[:] = file.read(16)
+            total = 0
             for i in range(16):
-                huffsize.append(read_byte(file))
-                Lh -= 1
-
-            huffcode = huffman_codes(huffsize)
-            for j in huffcode:
-                huffval.append(read_byte(file))
-                Lh -= 1
+                total += int(huffsize[i])
+            huffval = bytearray(file.read(total))
+            Lh -= 16 + total
 
             if Tc == 0:
-                huffman_dc_tables[Th] = map_codes_to_values(huffcode, huffval)
+                huffman_dc_tables[Th] = build_huffman_table(huffsize, huffval)
             else:
-                huffman_ac_tables[Th] = map_codes_to_values(huffcode, huffval)
-
-    @micropython.viper
-    def huffman_codes(huffsize):
-        huffcode = []
-        code = 0
-
-        for i in range(int(len(huffsize))):
-            si = int(huffsize[i])
-            for k in range(si):
-                huffcode.append((i + 1, code))
-                code += 1
-
-            code <<= 1
-
-        return huffcode
+                huffman_ac_tables[Th] = build_huffman_table(huffsize, huffval)
 
     @micropython.viper
     def read_dqt(file):
@@ -143,9 +284,8 @@ def jpeg(source, quality=8, callback=print, cache=False):
             Lq -= 1
 
             if Pq == 0:
-                for i in range(64):
-                    table.append(int(read_byte(file)))
-                    Lq -= 1
+                table.extend(file.read(64))
+                Lq -= 64
 
             else:
                 for i in range(64):
@@ -153,12 +293,20 @@ def jpeg(source, quality=8, callback=print, cache=False):
                     table.append(val)
                     Lq -= 2
 
-            q_table[Tq] = table
+            # stored in natural order like the data units, coefficients cut
+            # off by quality are zeroed at dequantization
+            prec = int(idct_precision)
+            natural = list(table)
+            for i in range(64):
+                z = int(zigzag[i])
+                natural[z] = 0 if z & 7 >= prec or z >> 3 >= prec else table[i]
+
+            q_table[Tq] = natural
 
     @micropython.native
     def read_sof(type, file):
-        nonlocal component
-        nonlocal XYP
+        nonlocal component, comp_index, rgb_ids
+        nonlocal XYP, frame_size, is_progressive
 
         Lf = read_word(file)
         Lf -= 2
@@ -171,8 +319,16 @@ def jpeg(source, quality=8, callback=print, cache=False):
         Nf = read_byte(file)
         Lf -= 1
 
-        XYP = X, Y, P
+        XYP = -(-X // scale), -(-Y // scale), P
+        setView(XYP[0], XYP[1])
+        frame_size = X, Y
+        is_progressive = type == 2
 
+        if Nf != 1 and Nf != 3:
+            raise ValueError('Unsupported number of components')
+        # components are numbered 1..Nf in frame order, scans refer to
+        # them through comp_index
+        ids = []
         while Lf > 0:
             C = read_byte(file)
             V = read_byte(file)
@@ -180,16 +336,54 @@ def jpeg(source, quality=8, callback=print, cache=False):
             Lf -= 3
             H = V >> 4
             V &= 0xF
-            component[C] = {}
-            component[C]['H'] = H
-            component[C]['V'] = V
-            component[C]['Tq'] = Tq
+            if Nf == 1:
+                # a single component is never interleaved, its MCU is one
+                # block whatever the sampling factors are
+                H = V = 1
+            ids.append(C)
+            comp_index[C] = len(ids)
+            component[len(ids)] = {'H': H, 'V': V, 'Tq': Tq}
+        rgb_ids = ids == [82, 71, 66]
 
-    @micropython.viper
+    @micropython.native
     def read_app(type, file):
-        Lp = int(read_word(file))
-        Lp -= 2
-        file.seek(Lp, 1)
+        nonlocal transform
+        n = read_word(file) - 2
+        if type == 14 and n >= 12:
+            data = file.read(12)
+            if bytes(data[:5]) == b'Adobe':
+                transform = data[11]
+            n -= 12
+        file.seek(n, 1)
+
+    @micropython.native
+    def setView(W, H):
+        nonlocal view
+        view = imgcache.view(crop, W, H)
+
+    @micropython.native
+    def region(top, bottom):
+        return imgcache.region(view, rx, ry, top, bottom)
+
+    @micropython.native
+    def mcu_in_view(w, h):
+        cx, cy, cw, ch, ox, oy = view
+        return offsetx < cx + cw and offsetx + w > cx and offsety < cy + ch and offsety + h > cy
+
+    @micropython.native
+    def skip_mcu(w, h):
+        # moves the output position past an MCU that is not shown
+        X, Y, P = XYP
+        setOffsetX(offsetx + w)
+        if offsetx >= X:
+            setOffsetX(0)
+            setOffsetY(offsety + min(h, Y - offsety))
+
+    @micropython.native
+    def read_dri(file):
+        nonlocal restart_interval
+        Lr = read_word(file)
+        restart_interval = read_word(file)
 
     @micropython.native
     def read_dnl(file):
@@ -203,12 +397,13 @@ def jpeg(source, quality=8, callback=print, cache=False):
         X, Y, P = XYP
 
         if Y == 0:
-            XYP = X, NL, P
+            XYP = X, -(-NL // scale), P
 
     @micropython.native
     def read_sos(file):
         nonlocal component
         nonlocal num_components
+        nonlocal scan_ss, scan_se, scan_ah, scan_al, scan_comps
 
         Ls = int(read_word(file))
         Ls -= 2
@@ -216,8 +411,10 @@ def jpeg(source, quality=8, callback=print, cache=False):
         Ns = int(read_byte(file))
         Ls -= 1
 
+        scan_comps = []
         for i in range(Ns):
-            Cs = int(read_byte(file))
+            Cs = int(comp_index[read_byte(file)])
+            scan_comps.append(Cs)
             Ls -= 1
             Ta = int(read_byte(file))
             Ls -= 1
@@ -226,12 +423,14 @@ def jpeg(source, quality=8, callback=print, cache=False):
             component[Cs]['Td'] = Td
             component[Cs]['Ta'] = Ta
 
-        Ss = read_byte(file)
+        scan_ss = read_byte(file)
         Ls -= 1
-        Se = read_byte(file)
+        scan_se = read_byte(file)
         Ls -= 1
         A = read_byte(file)
         Ls -= 1
+        scan_ah = A >> 4
+        scan_al = A & 0xF
 
         num_components = Ns
 
@@ -245,120 +444,159 @@ def jpeg(source, quality=8, callback=print, cache=False):
         return val
 
     @micropython.native
-    def bit_read(file):
-        nonlocal EOI
-        nonlocal inline_dc
-
-        input = file.read(1)
-        while input and not EOI:
-            if input == intb(0xFF):
-                cmd = file.read(1)
-                if cmd:
-                    if cmd == intb(0x00):
-                        input = intb(0xFF)
-                    elif cmd == intb(0xD9):
-                        EOI = True
-                    elif 0xD0 <= bint(cmd) <= 0xD7 and inline_dc:
-                        input = file.read(1)
-                    else:
-                        input = file.read(1)
-            if not EOI:
-                for i in range(7, -1, -1):
-                    yield (ord(input) >> i) & 0x01
-                input = file.read(1)
-
-        while True:
-            yield -1
+    def fill_bits():
+        nonlocal bitbuf, bitcnt, marker
+        while bitcnt <= 16:
+            byte = 0
+            if not marker:
+                byte = bit_stream.byte()
+                if byte < 0:
+                    marker = 0xD9
+                    byte = 0
+                while byte == 0xFF:
+                    cmd = bit_stream.byte()
+                    if cmd < 0:
+                        cmd = 0xD9
+                    if cmd == 0x00:
+                        break
+                    elif cmd != 0xFF:
+                        marker = cmd
+                        byte = 0
+            # past a marker (RSTn included) the scan is padded with zeros
+            bitbuf = (bitbuf << 8) | byte
+            bitcnt += 8
 
-    @micropython.viper
-    def get_bits(num: int, gen) -> int:
-        out = 0
-        for i in range(num):
-            out <<= 1
-            val = int(next(gen))
-            if val != -1:
-                out += val & 0x01
-            else:
-                return -1
+    @micropython.native
+    def get_bits(num):
+        nonlocal bitbuf, bitcnt
+        if bitcnt < num:
+            fill_bits()
+        bitcnt -= num
+        out = bitbuf >> bitcnt
+        bitbuf &= (1 << bitcnt) - 1
         return out
 
-    @micropython.viper
-    def read_data_unit(comp_num: int):
-        nonlocal bit_stream
-        nonlocal component
+    @micropython.native
+    def decode_huffman(table):
+        nonlocal bitbuf, bitcnt
+        if bitcnt < 16:
+            fill_bits()
+        lookup, maxcode, valoff, huffval = table
+        entry = lookup[bitbuf >> (bitcnt - 9)]
+        if entry:
+            bitcnt -= entry >> 8
+            bitbuf &= (1 << bitcnt) - 1
+            return entry & 0xFF
+
+        l = 10
+        code = bitbuf >> (bitcnt - 10)
+        while l < 16 and code > maxcode[l]:
+            l += 1
+            code = bitbuf >> (bitcnt - l)
+        if code > maxcode[l]:
+            return 0
+        bitcnt -= l
+        bitbuf &= (1 << bitcnt) - 1
+        return huffval[code + valoff[l]]
 
-        #gc.collect()
-        data = array('h')
+    @micropython.viper
+    def clear_du(du):
+        p = ptr16(du)
+        for i in range(64):
+            p[i] = 0
 
+    @micropython.native
+    def read_data_unit(comp_num, data):
+        # coefficients are written dequantized in natural order (not
+        # zigzag), only the decoded ones are multiplied, DC with its
+        # predictor added
         comp = component[comp_num]
-        huff_tbl = huffman_dc_tables[comp['Td']]
-
-        while int(len(data)) < 64:
-            key = 0
-
-            for bits in range(1, 17):
-                key_len = -1
-                key <<= 1
-
-                val = int(get_bits(1, bit_stream))
-                if val == -1:
-                    break
-                key |= val
-
-                if (bits, key) in huff_tbl:
-                    key_len = int(huff_tbl[(bits, key)])
-                    break
-
-            huff_tbl = huffman_ac_tables[comp['Ta']]
-
-            if key_len == -1:
-                break
-
-            elif key_len == 0xF0:
-                for i in range(16):
-                    data.append(0)
-                continue
-
-            if int(len(data)) != 0:
-                if key_len == 0x00:
-                    while int(len(data)) < 64:
-                        data.append(0)
-                    break
-
-                for i in range(key_len >> 4):
-                    if int(len(data)) < 64:
-                        data.append(0)
-                key_len &= 0x0F
-
-            if int(len(data)) >= 64:
-                break
-
-            if key_len != 0:
-                val = int(get_bits(key_len, bit_stream))
-                if val == -1:
+        q = q_table[comp['Tq']]
+        clear_du(data)
+
+        size = decode_huffman(huffman_dc_tables[comp['Td']])
+        if size:
+            dc_prev[comp_num - 1] += calc_add_bits(size, get_bits(size))
+        data[0] = dc_prev[comp_num - 1] * q[0]
+
+        huff_tbl = huffman_ac_tables[comp['Ta']]
+        k = 1
+        while k < 64:
+            rs = decode_huffman(huff_tbl)
+            size = rs & 0x0F
+            if size:
+                k += rs >> 4
+                if k > 63:
                     break
-                num = int(calc_add_bits(key_len, val))
-
-                data.append(num)
+                z = zigzag[k]
+                data[z] = calc_add_bits(size, get_bits(size)) * q[z]
+                k += 1
+            elif rs == 0xF0:
+                k += 16
             else:
-                data.append(0)
+                break
 
         return data
 
     @micropython.native
-    def restore_dc(data):
-        dc_prev = array('h', [0 for x in range(len(data[0]))])
-        out = []
+    def restart():
+        # every restart interval starts byte aligned after an RSTn marker
+        # with fresh DC predictors and no pending EOB run
+        nonlocal bitbuf, bitcnt, marker, eobrun, segment
+        bitbuf = 0
+        bitcnt = 0
+        eobrun = 0
+        if not marker:
+            marker = next_marker(bit_stream)
+        if 0xD0 <= marker <= 0xD7:
+            marker = 0
+        for i in range(4):
+            dc_prev[i] = 0
+        segment += 1
+
+    def open_source(source):
+        # files of all images are read into one buffer of the decoder
+        nonlocal readbuf
+        if isinstance(source, str) and not readbuf:
+            readbuf = bytearray(buffer_size)
+        return BlockReader(source, buffer_size, readbuf)
 
-        for mcu in data:
-            for comp_num in range(len(mcu)):
-                for du in range(len(mcu[comp_num])):
-                    if mcu[comp_num][du]:
-                        mcu[comp_num][du][0] += dc_prev[comp_num]
-                        dc_prev[comp_num] = mcu[comp_num][du][0]
-
-            out.append(mcu)
-        return out
+    @micropython.native
+    def index_segments(filename):
+        # file offsets of the restart intervals of the first scan
+        file = open_source(filename)
+        offsets = []
+        in_num = 0
+        while in_num != 0xda and in_num != 0xd9:
+            b = file.byte()
+            while b >= 0 and b != 0xFF:
+                b = file.byte()
+            while b == 0xFF:
+                b = file.byte()
+            if b < 0:
+                break
+            in_num = b
+            if not 0xd0 <= in_num <= 0xd9 and in_num != 0xda:
+                read_app(0, file)
+        if in_num == 0xda:
+            read_app(0, file)
+            offsets.append(file.tell())
+            buf = file.buf
+            prev = 0
+            n = file.fill()
+            while n:
+                for i in range(file.pos, file.pos + n):
+                    b = buf[i]
+                    if prev == 0xFF and b != 0 and b != 0xFF:
+                        if not 0xD0 <= b <= 0xD7:
+                            n = 0
+                            break
+                        offsets.append(file.start + i + 1)
+                    prev = b
+                file.pos = file.end
+                n = file.fill() if n else 0
+        file.close()
+        return offsets
 
     @micropython.native
     def read_mcu():
@@ -366,58 +604,37 @@ def jpeg(source, quality=8, callback=print, cache=False):
         nonlocal num_components
         nonlocal mcus_read
 
-        comp_num = mcu = list(range(num_components))
-
-        for i in comp_num:
-            comp = component[i + 1]
-            mcu[i] = []
-            for j in range(comp['H'] * comp['V']):
-                if not EOI:
-                    mcu[i].append(read_data_unit(i + 1))
+        # data units are read into the reused arrays of mcu_pool
+        mcu = mcu_pool
+        for i in range(num_components):
+            for du in mcu[i]:
+                read_data_unit(i + 1, du)
 
         mcus_read += 1
         return mcu
 
     @micropython.viper
     def dequantify(mcu):
-        nonlocal component
-        gc.collect()
-
-        out = mcu
-        for c in range(int(len(out))):
-            for du in range(int(len(out[c]))):
-                for i in range(int(len(out[c][du]))):
-                    out[c][du][i] = int(out[c][du][i]) * int(
-                        q_table[component[c + 1]['Tq']][i])
+        # progressive coefficients, baseline ones are dequantized while
+        # they are read
+        for c in range(int(len(mcu))):
+            q = q_table[component[c + 1]['Tq']]
+            for du in mcu[c]:
+                for i in range(64):
+                    du[i] = int(du[i]) * int(q[i])
 
-        return out
+        return mcu
 
     @micropython.viper
-    def zagzig(du):
-        map = [
-            array('h', [0, 1, 5, 6, 14, 15, 27, 28]),
-            array('h', [2, 4, 7, 13, 16, 26, 29, 42]),
-            array('h', [3, 8, 12, 17, 25, 30, 41, 43]),
-            array('h', [9, 11, 18, 24, 31, 40, 44, 53]),
-            array('h', [10, 19, 23, 32, 39, 45, 52, 54]),
-            array('h', [20, 22, 33, 38, 46, 51, 55, 60]),
-            array('h', [21, 34, 37, 47, 50, 56, 59, 61]),
-            array('h', [35, 36, 48, 49, 57, 58, 62, 63])
-        ]
-        ldu = int(len(du))
-
-        for x in range(8):
-            for y in range(8):
-                if int(map[x][y]) < ldu:
-                    map[x][y] = int(du[map[x][y]])
-                else:
-                    map[x][y] = 0
-            #gc.collect()
-        return map
+    def zagzig(du, out):
+        # zigzag order of progressive coefficients to natural order, out is
+        # a data unit of mcu_pool
+        for i in range(64):
+            out[zigzag[i]] = du[i]
+        return out
 
     @micropython.viper
     def for_each_du_in_mcu(mcu, func):
-        gc.collect()
         for i, comp in enumerate(mcu):
             for ii, cm in enumerate(mcu[i]):
                 mcu[i][ii] = func(cm)
@@ -432,38 +649,519 @@ def jpeg(source, quality=8, callback=print, cache=False):
             return 1.0
 
     @micropython.viper
-    def idct(matrix):
-        out = [array('b', range(8)) for i in range(8)]
+    def idct_float(matrix):
+        out = array('h', zero_du)
         for x in range8:
             for y in range8:
                 sum = 0
                 for u in rangeIDCT:
                     for v in rangeIDCT:
                         sum += int(
-                            round(matrix[v][u] * idct_table[u][x] * idct_table[v][y]))
+                            round(matrix[v * 8 + u] * idct_table[u][x] * idct_table[v][y]))
 
-                out[y][x] = int(sum // 4)
+                out[y * 8 + x] = int(sum // 4)
 
         return out
 
-    @micropython.viper
-    def show_all(data):
+    @micropython.native
+    def idct(matrix):
+        # separable Loeffler-Ligtenberg-Moschytz IDCT in 13 bit fixed point,
+        # same algorithm and constants as libjpeg's jidctint.c
+        ws = workspace
+        ac = False
+        for c in range(8):
+            if not (matrix[8 + c] or matrix[16 + c] or matrix[24 + c]
+                    or matrix[32 + c] or matrix[40 + c] or matrix[48 + c]
+                    or matrix[56 + c]):
+                dc = matrix[c] << 2
+                if dc and c:
+                    ac = True
+                for r in range(c, 64, 8):
+                    ws[r] = dc
+                continue
+            ac = True
+
+            z2 = matrix[16 + c]
+            z3 = matrix[48 + c]
+            z1 = (z2 + z3) * 4433
+            tmp2 = z1 - z3 * 15137
+            tmp3 = z1 + z2 * 6270
+            z2 = matrix[c]
+            z3 = matrix[32 + c]
+            tmp0 = (z2 + z3) << 13
+            tmp1 = (z2 - z3) << 13
+            tmp10 = tmp0 + tmp3 + 1024
+            tmp13 = tmp0 - tmp3 + 1024
+            tmp11 = tmp1 + tmp2 + 1024
+            tmp12 = tmp1 - tmp2 + 1024
+
+            tmp0 = matrix[56 + c]
+            tmp1 = matrix[40 + c]
+            tmp2 = matrix[24 + c]
+            tmp3 = matrix[8 + c]
+            z1 = tmp0 + tmp3
+            z2 = tmp1 + tmp2
+            z3 = tmp0 + tmp2
+            z4 = tmp1 + tmp3
+            z5 = (z3 + z4) * 9633
+            z1 *= -7373
+            z2 *= -20995
+            z3 = z3 * -16069 + z5
+            z4 = z4 * -3196 + z5
+            tmp0 = tmp0 * 2446 + z1 + z3
+            tmp1 = tmp1 * 16819 + z2 + z4
+            tmp2 = tmp2 * 25172 + z2 + z3
+            tmp3 = tmp3 * 12299 + z1 + z4
+
+            ws[c] = (tmp10 + tmp3) >> 11
+            ws[56 + c] = (tmp10 - tmp3) >> 11
+            ws[8 + c] = (tmp11 + tmp2) >> 11
+            ws[48 + c] = (tmp11 - tmp2) >> 11
+            ws[16 + c] = (tmp12 + tmp1) >> 11
+            ws[40 + c] = (tmp12 - tmp1) >> 11
+            ws[24 + c] = (tmp13 + tmp0) >> 11
+            ws[32 + c] = (tmp13 - tmp0) >> 11
+
+        if not ac:
+            dc = (matrix[0] + 4) >> 3
+            for r in range(64):
+                matrix[r] = dc
+            return matrix
+
+        # the second pass reads the workspace only, so the output
+        # replaces the input block
+        out = matrix
+        for r in range(0, 64, 8):
+            if not (ws[r + 1] or ws[r + 2] or ws[r + 3] or ws[r + 4]
+                    or ws[r + 5] or ws[r + 6] or ws[r + 7]):
+                dc = (ws[r] + 16) >> 5
+                for c in range(r, r + 8):
+                    out[c] = dc
+                continue
+
+            z2 = ws[r + 2]
+            z3 = ws[r + 6]
+            z1 = (z2 + z3) * 4433
+            tmp2 = z1 - z3 * 15137
+            tmp3 = z1 + z2 * 6270
+            z2 = ws[r]
+            z3 = ws[r + 4]
+            tmp0 = (z2 + z3) << 13
+            tmp1 = (z2 - z3) << 13
+            tmp10 = tmp0 + tmp3 + 131072
+            tmp13 = tmp0 - tmp3 + 131072
+            tmp11 = tmp1 + tmp2 + 131072
+            tmp12 = tmp1 - tmp2 + 131072
+
+            tmp0 = ws[r + 7]
+            tmp1 = ws[r + 5]
+            tmp2 = ws[r + 3]
+            tmp3 = ws[r + 1]
+            z1 = tmp0 + tmp3
+            z2 = tmp1 + tmp2
+            z3 = tmp0 + tmp2
+            z4 = tmp1 + tmp3
+            z5 = (z3 + z4) * 9633
+            z1 *= -7373
+            z2 *= -20995
+            z3 = z3 * -16069 + z5
+            z4 = z4 * -3196 + z5
+            tmp0 = tmp0 * 2446 + z1 + z3
+            tmp1 = tmp1 * 16819 + z2 + z4
+            tmp2 = tmp2 * 25172 + z2 + z3
+            tmp3 = tmp3 * 12299 + z1 + z4
+
+            out[r] = (tmp10 + tmp3) >> 18
+            out[r + 7] = (tmp10 - tmp3) >> 18
+            out[r + 1] = (tmp11 + tmp2) >> 18
+            out[r + 6] = (tmp11 - tmp2) >> 18
+            out[r + 2] = (tmp12 + tmp1) >> 18
+            out[r + 5] = (tmp12 - tmp1) >> 18
+            out[r + 3] = (tmp13 + tmp0) >> 18
+            out[r + 4] = (tmp13 - tmp0) >> 18
+
+        return out
+
+    @micropython.native
+    def idct_scaled(matrix):
+        # block-point IDCT of the lowest frequencies, outputs a
+        # downscaled block directly to the first block * block values
+        if block == 1:
+            matrix[0] = (matrix[0] + 4) >> 3
+            return matrix
+        n = block
+        t = scaled_table
+        ws = workspace
+        for u in range(n):
+            for y in range(n):
+                acc = 1024
+                for v in range(n):
+                    acc += matrix[v * 8 + u] * t[v * n + y]
+                ws[y * n + u] = acc >> 11
+
+        out = matrix
+        for y in range(0, n * n, n):
+            for x in range(n):
+                acc = 65536
+                for u in range(n):
+                    acc += ws[y + u] * t[u * n + x]
+                out[y + x] = acc >> 17
+
+        return out
+
+    @micropython.native
+    def prepare_output(n):
+        nonlocal blockbuf, planes, chroma, mcu_w, mcu_h, ncomp, colors, mcu_pool
         H = array('b')
         V = array('b')
 
-        for i in range(int(num_components)):
+        for i in range(n):
             H.append(component[i + 1]['H'])
             V.append(component[i + 1]['V'])
+            dc_prev[i] = 0
+
+        X, Y, P = XYP
+        mcus_x = -(-X // (block * max(H)))
+        mcus_y = -(-Y // (block * max(V)))
+        # buffers are kept for the next image of the same MCU size
+        size = block * max(H) * block * max(V)
+        if mcu_w * mcu_h != size or len(planes) < n:
+            planes = [array('h', (0 for i in range(size))) for i in range(n)]
+            chroma = array('h', planes[0]) if fancy else array('h')
+        mcu_w = block * max(H)
+        mcu_h = block * max(V)
+        if blockcallback and len(blockbuf) != size * pxsize:
+            blockbuf = bytearray(size * pxsize)
+        if len(colors) != mcu_w:
+            colors = array('i', range(mcu_w))
+        if [len(dus) for dus in mcu_pool] != [H[i] * V[i] for i in range(n)]:
+            mcu_pool = [[array('h', zero_du) for j in range(H[i] * V[i])] for i in range(n)]
+        # grayscale, RGB or YCbCr
+        ncomp = 1 if n == 1 else 2 if transform == 0 or rgb_ids else 3
+        gc.collect()
+        return H, V, mcus_x, mcus_y
+
+    @micropython.native
+    def decode_scan():
+        # generator, yields the region drawn by every step_mcus MCUs
+        nonlocal mcus_read, bitbuf, bitcnt, marker, segment, EOI
+        idct_fn = idct_scaled if scale > 1 else idct if fastidct else idct_float
+        H, V, mcus_x, mcus_y = prepare_output(num_components)
+        total = mcus_x * mcus_y
+        mcus_read = 0
+        segment = 0
+        setOffsetX(0)
+        setOffsetY(0)
+        mw = block * max(H)
+        mh = block * max(V)
+        # MCUs outside of the view are only entropy decoded to track DC
+        bottom = view[1] + view[3]
+        ri = restart_interval
+        # MCUs since the last yield and the first image row they cover
+        n = 0
+        top = 0
+        if segment_list is not None and ri:
+            # restart intervals are independent, any subset of them can be
+            # decoded by seeking to its offset
+            for k in segment_list:
+                first = k * ri
+                last = min(first + ri, total) - 1
+                if first // mcus_x * mh >= bottom or (last // mcus_x + 1) * mh <= view[1]:
+                    continue
+                if n:
+                    yield region(top, -(-mcus_read // mcus_x) * mh)
+                    n = 0
+                segment = k
+                bit_stream.seek(segment_offsets[k])
+                bitbuf = 0
+                bitcnt = 0
+                marker = 0
+                for i in range(4):
+                    dc_prev[i] = 0
+                mcus_read = k * ri
+                setOffsetX(mcus_read % mcus_x * block * max(H))
+                setOffsetY(mcus_read // mcus_x * block * max(V))
+                top = offsety
+                end = min(mcus_read + ri, total)
+                while mcus_read < end:
+                    mcu = read_mcu()
+                    if mcu_in_view(mw, mh):
+                        show(transform_mcu(mcu, idct_fn), H, V)
+                    else:
+                        skip_mcu(mw, mh)
+                    n += 1
+                    if n == step_mcus:
+                        yield region(top, -(-mcus_read // mcus_x) * mh)
+                        top = mcus_read // mcus_x * mh
+                        n = 0
+            bit_stream.seek(0, 2)
+            marker = 0
+            if n:
+                yield region(top, -(-mcus_read // mcus_x) * mh)
+            return
+
+        while mcus_read < total:
+            if ri and mcus_read and not mcus_read % ri:
+                restart()
+            mcu = read_mcu()
+            if mcu_in_view(mw, mh):
+                show(transform_mcu(mcu, idct_fn), H, V)
+            else:
+                skip_mcu(mw, mh)
+            n += 1
+            if n == step_mcus:
+                yield region(top, -(-mcus_read // mcus_x) * mh)
+                top = mcus_read // mcus_x * mh
+                n = 0
+            if offsety >= bottom:
+                # the rest of the image is not needed
+                EOI = True
+                break
+        if n:
+            yield region(top, -(-mcus_read // mcus_x) * mh)
+
+    @micropython.native
+    def transform_mcu(mcu, idct_fn):
+        for_each_du_in_mcu(mcu, idct_fn)
+        return mcu
+
+    @micropython.native
+    def init_coefficients():
+        # progressive frames are decoded into a buffer of quantized
+        # coefficients (zigzag order), one array('h') per block
+        X, Y = frame_size
+        Hmax = max(c['H'] for c in component.values())
+        Vmax = max(c['V'] for c in component.values())
+        mcus_x = -(-X // (8 * Hmax))
+        mcus_y = -(-Y // (8 * Vmax))
+        for comp in component.values():
+            comp['bw'] = mcus_x * comp['H']
+            # non-interleaved scans cover only blocks inside the image
+            comp['bx'] = -(-(-(-X * comp['H'] // Hmax)) // 8)
+            comp['by'] = -(-(-(-Y * comp['V'] // Vmax)) // 8)
+            comp['coef'] = [array('h', zero_du) for i in range(comp['bw'] * mcus_y * comp['V'])]
+            gc.collect()
+
+    @micropython.native
+    def decode_dc_first(du, i, table):
+        size = decode_huffman(table)
+        if size:
+            dc_prev[i] += calc_add_bits(size, get_bits(size))
+        du[0] = dc_prev[i] << scan_al
+
+    @micropython.native
+    def decode_dc_refine(du, i, table):
+        if get_bits(1):
+            du[0] |= 1 << scan_al
+
+    @micropython.native
+    def decode_ac_first(du, i, table):
+        nonlocal eobrun
+        if eobrun:
+            eobrun -= 1
+            return
+        k = scan_ss
+        while k <= scan_se:
+            rs = decode_huffman(table)
+            size = rs & 0x0F
+            r = rs >> 4
+            if size:
+                k += r
+                if k > 63:
+                    break
+                du[k] = calc_add_bits(size, get_bits(size)) << scan_al
+                k += 1
+            elif r == 15:
+                k += 16
+            else:
+                eobrun = (1 << r) - 1
+                if r:
+                    eobrun += get_bits(r)
+                break
 
-        for mcu in data:
-            show(mcu, H, V)
+    @micropython.native
+    def decode_ac_refine(du, i, table):
+        # successive approximation: one correction bit for every nonzero
+        # coefficient passed, new coefficients are +-1 << Al
+        nonlocal eobrun
+        p1 = 1 << scan_al
+        m1 = -1 << scan_al
+        k = scan_ss
+        se = scan_se
+        if not eobrun:
+            while k <= se:
+                rs = decode_huffman(table)
+                size = rs & 0x0F
+                r = rs >> 4
+                val = 0
+                if size:
+                    val = p1 if get_bits(1) else m1
+                elif r != 15:
+                    eobrun = 1 << r
+                    if r:
+                        eobrun += get_bits(r)
+                    break
+                while k <= se:
+                    c = du[k]
+                    if c:
+                        if get_bits(1) and not c & p1:
+                            du[k] = c + p1 if c >= 0 else c + m1
+                    else:
+                        if r == 0:
+                            break
+                        r -= 1
+                    k += 1
+                if val and k <= 63:
+                    du[k] = val
+                k += 1
+        if eobrun:
+            while k <= se:
+                c = du[k]
+                if c and get_bits(1) and not c & p1:
+                    du[k] = c + p1 if c >= 0 else c + m1
+                k += 1
+            eobrun -= 1
+
+    @micropython.native
+    def decode_progressive_scan():
+        # generator, coefficients are only buffered, so it yields None after
+        # every step_mcus MCUs (blocks in non-interleaved scans)
+        nonlocal eobrun
+        eobrun = 0
+        if scan_ss == 0:
+            decode_du = decode_dc_refine if scan_ah else decode_dc_first
+        else:
+            decode_du = decode_ac_refine if scan_ah else decode_ac_first
+        comps = []
+        tables = []
+        for i in range(len(scan_comps)):
+            comp = component[scan_comps[i]]
+            comps.append(comp)
+            if scan_ss == 0:
+                tables.append(huffman_dc_tables[comp['Td']])
+            else:
+                tables.append(huffman_ac_tables[comp['Ta']])
+            dc_prev[i] = 0
+
+        ri = restart_interval
+        n = 0
+        m = 0
+        if len(comps) == 1:
+            comp = comps[0]
+            coef = comp['coef']
+            table = tables[0]
+            for by in range(comp['by']):
+                row = by * comp['bw']
+                for bx in range(comp['bx']):
+                    if ri and n and not n % ri:
+                        restart()
+                    decode_du(coef[row + bx], 0, table)
+                    n += 1
+                    m += 1
+                    if m == step_mcus:
+                        yield None
+                        m = 0
+            return
+
+        X, Y = frame_size
+        Hmax = max(c['H'] for c in component.values())
+        Vmax = max(c['V'] for c in component.values())
+        for my in range(-(-Y // (8 * Vmax))):
+            for mx in range(-(-X // (8 * Hmax))):
+                if ri and n and not n % ri:
+                    restart()
+                n += 1
+                for i in range(len(comps)):
+                    comp = comps[i]
+                    coef = comp['coef']
+                    H = comp['H']
+                    V = comp['V']
+                    for v in range(V):
+                        row = (my * V + v) * comp['bw'] + mx * H
+                        for h in range(H):
+                            decode_du(coef[row + h], i, tables[i])
+                m += 1
+                if m == step_mcus:
+                    yield None
+                    m = 0
+
+    @micropython.native
+    def show_coefficients():
+        # runs the buffered coefficients through the same pipeline as
+        # baseline MCUs, so it can be called after any scan, generator like
+        # decode_scan
+        idct_fn = idct_scaled if scale > 1 else idct if fastidct else idct_float
+        n = len(component)
+        H, V, mcus_x, mcus_y = prepare_output(n)
+        setOffsetX(0)
+        setOffsetY(0)
+        mw = block * max(H)
+        mh = block * max(V)
+        m = 0
+        top = 0
+        for my in range(mcus_y):
+            if offsety >= view[1] + view[3]:
+                break
+            for mx in range(mcus_x):
+                if not mcu_in_view(mw, mh):
+                    skip_mcu(mw, mh)
+                    continue
+                # data units of mcu_pool are reused like in decode_scan
+                mcu = mcu_pool
+                for i in range(n):
+                    comp = component[i + 1]
+                    coef = comp['coef']
+                    dus = mcu[i]
+                    j = 0
+                    for v in range(V[i]):
+                        row = (my * V[i] + v) * comp['bw'] + mx * H[i]
+                        for h in range(H[i]):
+                            zagzig(coef[row + h], dus[j])
+                            j += 1
+                dequantify(mcu)
+                for_each_du_in_mcu(mcu, idct_fn)
+                show(mcu, H, V)
+                m += 1
+                if m == step_mcus:
+                    yield region(top, (my + 1) * mh)
+                    top = offsety
+                    m = 0
+        if m:
+            yield region(top, offsety + mh)
+
+    @micropython.native
+    def show_dc(fill):
+        # coarse preview from DC coefficients only, every block is drawn
+        # as one rectangle with fill(x, y, w, h, color)
+        n = len(component)
+        H, V, mcus_x, mcus_y = prepare_output(n)
+        Hmax = max(H)
+        Vmax = max(V)
+        cx, cy, cw, ch, ox, oy = view
+        for my in range(mcus_y):
+            for mx in range(mcus_x):
+                for v in range(Vmax):
+                    py = (my * Vmax + v) * block
+                    y0 = max(py, cy)
+                    y1 = min(py + block, cy + ch)
+                    for h in range(Hmax):
+                        px = (mx * Hmax + h) * block
+                        x0 = max(px, cx)
+                        x1 = min(px + block, cx + cw)
+                        if x0 >= x1 or y0 >= y1:
+                            continue
+                        for i in range(n):
+                            comp = component[i + 1]
+                            bx = mx * H[i] + h * H[i] // Hmax
+                            by = my * V[i] + v * V[i] // Vmax
+                            dc = comp['coef'][by * comp['bw'] + bx][0] * q_table[comp['Tq']][0]
+                            planes[i][0] = (dc + 4) >> 3
+                        convert(0, 1, px, py)
+                        fill(rx + x0 - ox, ry + y0 - oy, x1 - x0, y1 - y0, colors[0])
 
     @micropython.native
-    def setOffsetX(val, bx=False, by=False):
+    def setOffsetX(val):
         nonlocal offsetx
-        if cache and bx and by:
-            cachedX.append(bx)
-            cachedY.append(by)
         offsetx = val
 
     @micropython.native
@@ -471,178 +1169,452 @@ def jpeg(source, quality=8, callback=print, cache=False):
         nonlocal offsety
         offsety = val
 
+    def setCrop(region):
+        nonlocal crop
+        crop = region
+
+    def setStep(mcus):
+        nonlocal step_mcus
+        step_mcus = mcus
+
+    def setSink(sink):
+        nonlocal callback, blockcallback
+        if profile:
+            sink = profile.wrap('output', sink)
+        if blockcallback:
+            blockcallback = sink
+        else:
+            callback = sink
+
     @micropython.native
-    def prepareArr(ho, vo):
-        return [[array('b') for x in range(8 * int(ho))] for y in range(8 * int(vo))]
+    def setSegments(numbers, offsets):
+        nonlocal segment_list, segment_offsets
+        segment_list = numbers
+        segment_offsets = offsets
 
-    def showCached():
-        nonlocal offsetx, offsety
-        X, Y, P = XYP
-        ind = 0
-        offsetx = 0
-        offsety = 0
-        for i in range(len(cachedX)):
-            bX = cachedX[i]
-            bY = cachedY[i]
-            for y in range(bY):
-                for x in range(bX):
-                    callback(rx + x + offsetx, ry + y + offsety, cached[ind])
-                    ind += 1
-            offsetx += bX
-            if offsetx > X:
-                offsetx = 0
-                offsety += bY
+    def getSegment():
+        return segment
+
+    @micropython.native
+    def setProgressive(fill, scans):
+        nonlocal progressive, refine
+        progressive = fill
+        refine = scans
+
+    @micropython.viper
+    def upsample(dus, plane, hs: int, vs: int):
+        # writes blocks of one component to its MCU plane, every sample is
+        # repeated hs times horizontally and vs times vertically
+        bs = int(block)
+        stride = int(mcu_w)
+        nh = stride // (bs * hs)
+        o = ptr16(plane)
+        for a in range(int(len(dus))):
+            s = ptr16(dus[a])
+            d = (a // nh) * bs * vs * stride + (a % nh) * bs * hs
+            k = 0
+            if hs == 1 and vs == 1:
+                for y in range(bs):
+                    for x in range(d, d + bs):
+                        o[x] = s[k]
+                        k += 1
+                    d += stride
+            elif hs == 2 and vs == 1:
+                for y in range(bs):
+                    for x in range(d, d + 2 * bs, 2):
+                        o[x] = s[k]
+                        o[x + 1] = s[k]
+                        k += 1
+                    d += stride
+            elif hs == 2 and vs == 2:
+                for y in range(bs):
+                    for x in range(d, d + 2 * bs, 2):
+                        o[x] = s[k]
+                        o[x + 1] = s[k]
+                        o[x + stride] = s[k]
+                        o[x + stride + 1] = s[k]
+                        k += 1
+                    d += 2 * stride
+            else:
+                for y in range(bs):
+                    for x in range(bs):
+                        for j in range(vs):
+                            for i in range(d + j * stride, d + j * stride + hs):
+                                o[i] = s[k]
+                        d += hs
+                        k += 1
+                    d += vs * stride - bs * hs
+
+    @micropython.viper
+    def gather(dus, hs: int, vs: int):
+        # blocks of a subsampled component side by side in chroma
+        bs = int(block)
+        stride = int(mcu_w) // hs
+        nh = stride // bs
+        o = ptr16(chroma)
+        for a in range(int(len(dus))):
+            s = ptr16(dus[a])
+            d = (a // nh) * bs * stride + (a % nh) * bs
+            k = 0
+            for y in range(bs):
+                for x in range(d, d + bs):
+                    o[x] = s[k]
+                    k += 1
+                d += stride
+
+    @micropython.viper
+    def smooth(plane, hs: int, vs: int):
+        # triangle filter upsampling of chroma by 2 (libjpeg "fancy"
+        # upsampling), every output sample is 3/4 of the nearest input
+        # sample and 1/4 of the next nearest one, MCU edges are replicated
+        w = int(mcu_w) // hs
+        h = int(mcu_h) // vs
+        s = ptr16(chroma)
+        o = ptr16(plane)
+        d = 0
+        for r in range(h):
+            for t in range(vs):
+                c = r * w
+                n = c
+                if vs == 2:
+                    # row of the vertical neighbor
+                    n = r - 1 + 2 * t
+                    if n < 0:
+                        n = 0
+                    if n >= h:
+                        n = h - 1
+                    n *= w
+                # column sums are 4 times the sample value, samples are
+                # offset by 0x8000 to keep them positive
+                p = 0
+                for i in range(w):
+                    cs = ((s[c + i] + 0x8000) & 0xFFFF) * 3 + ((s[n + i] + 0x8000) & 0xFFFF)
+                    if hs == 1:
+                        o[d] = ((cs + 1 + t) >> 2) - 0x8000
+                        d += 1
+                        continue
+                    if i == 0:
+                        p = cs
+                    j = i + 1 if i < w - 1 else i
+                    q = ((s[c + j] + 0x8000) & 0xFFFF) * 3 + ((s[n + j] + 0x8000) & 0xFFFF)
+                    o[d] = ((cs * 3 + p + 8) >> 4) - 0x8000
+                    o[d + 1] = ((cs * 3 + q + 7) >> 4) - 0x8000
+                    d += 2
+                    p = cs
+
+    @micropython.native
+    def startCache(w, h):
+        nonlocal cacheimg, cached
+        cacheimg = imgcache.new(w, h, pxsize)
+        cached = cacheimg.data if cacheimg else bytearray(0)
 
     @micropython.viper
     def show(mcu, H, V):
-        #print(gc.mem_free())
         Hout = int(max(H))
         Vout = int(max(V))
-
-        #gc.collect()
-
-        out = prepareArr(Hout, Vout)
         for i in range(int(len(mcu))):
-            Hs = int(Hout // int(H[i]))
-            Vs = int(Vout // int(V[i]))
             Hin = int(H[i])
             Vin = int(V[i])
             comp = mcu[i]
-
-            if int(len(comp)) != int(Hin * Vin):
+            if int(len(comp)) != Hin * Vin:
                 return []
-
-            for v in range(Vout):
-                for h in range(Hout):
-                    a = int((h // Hs) + Hin * (v // Vs))
-                    for y in range(8):
-                        b = int(y // Vs)
-                        for x in range(8):
-                            c = int(x // Hs)
-                            out[y + v * 8][x + h * 8].append(comp[a][b][c])
-                        #gc.collect()
-        mcu.clear()
+            hs = Hout // Hin
+            vs = Vout // Vin
+            if fancy and hs <= 2 and vs <= 2 and hs * vs > 1:
+                gather(comp, hs, vs)
+                smooth(planes[i], hs, vs)
+            else:
+                upsample(comp, planes[i], hs, vs)
         X, Y, P = XYP
-        ybmax = int(min(Y, len(out)))
-        for y in range(ybmax):
-            xbmax = int(min(X, len(out[y])))
-            if y + int(offsety) > int(Y):
-                break
-            for x in range(xbmax):
-                if x + int(offsetx) > int(X):
-                    break
-                clr = out[y][x]
-                rgbClr = int(rgb_to_int(YCbCr2RGB(clr[0], clr[1], clr[2])))
-                callback(
-                    int(rx) + x + int(offsetx),
-                    int(ry) + y + int(offsety), rgbClr)
-                if cache:
-                    cached.append(rgbClr)
-
-        setOffsetX(int(offsetx) + xbmax, xbmax, ybmax)
+        ox = int(offsetx)
+        oy = int(offsety)
+        mw = int(mcu_w)
+        ybmax = int(min(int(Y) - oy, mcu_h))
+        xbmax = int(min(int(X) - ox, mw))
+        # part of the MCU inside the view
+        cx = int(view[0])
+        cy = int(view[1])
+        cw = int(view[2])
+        x0 = cx - ox
+        y0 = cy - oy
+        x1 = x0 + cw
+        y1 = y0 + int(view[3])
+        if x0 < 0:
+            x0 = 0
+        if y0 < 0:
+            y0 = 0
+        if x1 > xbmax:
+            x1 = xbmax
+        if y1 > ybmax:
+            y1 = ybmax
+        bw = x1 - x0
+        bh = y1 - y0
+        sx = int(rx) + ox - int(view[4])
+        sy = int(ry) + oy - int(view[5])
+        c = ptr32(colors)
+        for y in range(y0, y1):
+            convert(y * mw + x0, bw, ox + x0, oy + y)
+            if blockcallback:
+                store(blockbuf, (y - y0) * bw, bw)
+            else:
+                for x in range(bw):
+                    callback(sx + x0 + x, sy + y, c[x])
+            if cached:
+                store(cached, (oy + y - cy) * cw + ox + x0 - cx, bw)
+
+        if blockcallback and bw > 0 and bh > 0:
+            show_block(sx + x0, sy + y0, bw, bh)
+        setOffsetX(ox + xbmax)
         if offsetx >= X:
             setOffsetX(0)
             setOffsetY(int(offsety) + ybmax)
-        out.clear()
         return []
 
-    @micropython.viper
-    def clip(x: int) -> int:
-        if x > 255:
-            return 255
-        elif x < 0:
-            return 0
-        else:
-            return int(x)
-
-    @micropython.viper
-    def clamp(x: int) -> int:
-        x = int((int(abs(x)) + x) // 2)
-        if int(x) > 255:
-            return 255
-        else:
-            return int(round(x))
+    @micropython.native
+    def build_color_tables():
+        nonlocal clip_table, cr_r, cb_b, cb_g, cr_g
+        # integer YCbCr to RGB (JFIF), R = Y + 1.402 Cr,
+        # G = Y - 0.34414 Cb - 0.71414 Cr, B = Y + 1.772 Cb, red and blue
+        # tables are offset by 256, green ones (8 bit fraction) by 32768,
+        # so they fit unsigned arrays
+        cr_r = array('H', (256 + (91881 * (i - 128) + 32768 >> 16) for i in range(256)))
+        cb_b = array('H', (256 + (116130 * (i - 128) + 32768 >> 16) for i in range(256)))
+        cb_g = array('H', (32768 - 88 * (i - 128) for i in range(256)))
+        cr_g = array('H', (32768 - 183 * (i - 128) for i in range(256)))
+        # range limit, clip_table[i] is i - 256 clamped to 0..255, IDCT
+        # samples (centered on 0) are looked up at (s + 384) & 1023
+        clip_table = bytes(max(0, min(255, i - 256)) for i in range(1024))
 
     @micropython.viper
-    def YCbCr2RGB(Y, Cb, Cr):
-        Cred = 0.299
-        Cgreen = 0.587
-        Cblue = 0.114
-
-        R = Cr * (2. - 2. * Cred) + Y
-        B = Cb * (2. - 2. * Cblue) + Y
-        G = (Y - Cblue * B - Cred * R) / Cgreen
-
-        return clamp(round(R + 128.)), clamp(round(G + 128.)), clamp(round(B + 128.))
+    def convert(k: int, n: int, x: int, y: int):
+        # n pixels from index k of the MCU planes to output colors, x and y
+        # are image coordinates of the first one (for dithering)
+        o = ptr32(colors)
+        lim = ptr8(clip_table)
+        fmt = int(output_format)
+        nc = int(ncomp)
+        p0 = ptr16(planes[0])
+        p1 = p0
+        p2 = p0
+        if nc > 1:
+            p1 = ptr16(planes[1])
+            p2 = ptr16(planes[2])
+        rt = ptr16(cr_r)
+        bt = ptr16(cb_b)
+        gb = ptr16(cb_g)
+        gr = ptr16(cr_g)
+        for i in range(n):
+            r = lim[(p0[k + i] + 384) & 1023]
+            g = r
+            b = r
+            if nc == 2:
+                g = lim[(p1[k + i] + 384) & 1023]
+                b = lim[(p2[k + i] + 384) & 1023]
+            elif nc == 3:
+                Y = r
+                cb = lim[(p1[k + i] + 384) & 1023]
+                cr = lim[(p2[k + i] + 384) & 1023]
+                r = lim[Y + rt[cr]]
+                g = lim[Y + ((gb[cb] + gr[cr] + 128) >> 8)]
+                b = lim[Y + bt[cb]]
+            if fmt == 0:
+                o[i] = (r << 16) | (g << 8) | b
+            elif fmt >= 3:
+                if nc > 1:
+                    r = (r * 77 + g * 150 + b * 29) >> 8
+                if fmt == 4:
+                    r = 1 if r > int(bayer[((y & 3) << 2) | ((x + i) & 3)]) else 0
+                o[i] = r
+            else:
+                c = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+                if fmt == 2:
+                    c = ((c & 0xFF) << 8) | (c >> 8)
+                o[i] = c
 
     @micropython.viper
-    def YCbCr2Y(Y, Cb, Cr):
-        return Y, Y, Y
-
-    def processFile(filename, onlyMeta=False):
-        nonlocal bit_stream, idct_table, data, huffman_ac_tables, huffman_dc_tables, idct_table, q_table
-        idct_table = [ array('f', [(C(u) * cos(((2.0 * x + 1.0) * u * pi) / 16.0)) for x in range(8)]) for u in range(idct_precision)]
-
-        if isinstance(filename, str):
-            input_file = open(filename, "rb")
-        elif isinstance(filename, bytes):
-            input_file = BytesIO(filename)
-
-        in_char = input_file.read(1)
+    def store(buf, i: int, n: int):
+        # n output colors as pixels from index i of buf
+        p = ptr8(buf)
+        c = ptr32(colors)
+        s = int(pxsize)
+        i *= s
+        for j in range(n):
+            v = c[j]
+            if s == 3:
+                p[i] = (v >> 16) & 0xFF
+                p[i + 1] = (v >> 8) & 0xFF
+                p[i + 2] = v & 0xFF
+            elif s == 2:
+                p[i] = v >> 8
+                p[i + 1] = v & 0xFF
+            else:
+                p[i] = v
+            i += s
 
-        while in_char:
-            if in_char == intb(0xff):
-                in_char = input_file.read(1)
-                in_num = bint(in_char)
+    @micropython.native
+    def next_marker(file):
+        nonlocal marker, EOI
+        if marker:
+            in_num = marker
+            marker = 0
+        else:
+            in_num = 0
+            while not in_num:
+                in_num = file.byte()
+                while in_num >= 0 and in_num != 0xFF:
+                    in_num = file.byte()
+                while in_num == 0xFF:
+                    in_num = file.byte()
+                if in_num < 0:
+                    return -1
+        if in_num == 0xD9:
+            EOI = True
+        return in_num
+
+    def processFile(filename):
+        # generator, yields the steps of decode_scan, decode_progressive_scan
+        # and show_coefficients
+        nonlocal bit_stream, bitbuf, bitcnt, marker, idct_table, scaled_table, huffman_ac_tables, huffman_dc_tables, q_table
+        nonlocal EOI, component, comp_index, restart_interval, transform
+        EOI = False
+        component = {}
+        comp_index = {}
+        restart_interval = 0
+        transform = -1
+        if not clip_table:
+            build_color_tables()
+        huffman_ac_tables = [0, 0, 0, 0]
+        huffman_dc_tables = [0, 0, 0, 0]
+        q_table = [[], [], [], []]
+        if not scaled_table:
+            # IDCT tables depend on decoder options only
+            idct_table = [ array('f', [(C(u) * cos(((2.0 * x + 1.0) * u * pi) / 16.0)) for x in range(8)]) for u in range(idct_precision)]
+            scaled_table = array('i', [round(C(u) * cos(((2.0 * x + 1.0) * u * pi) / (2.0 * block)) * 8192) for u in range(block) for x in range(block)])
+
+        input_file = open_source(filename)
+        if profile and input_file.file:
+            input_file.file = profile.reader(input_file.file)
+        try:
+            marker = 0
+            in_num = next_marker(input_file)
+            scans = 0
+            shown = True
+            dc_comps = []
+
+            while in_num >= 0 and not EOI:
                 if 0xe0 <= in_num <= 0xef:
                     read_app(in_num - 0xe0, input_file)
                 elif in_num == 0xdb:
                     read_dqt(input_file)
                 elif in_num == 0xdc:
                     read_dnl(input_file)
+                elif in_num == 0xdd:
+                    read_dri(input_file)
                 elif in_num == 0xc4:
                     read_dht(input_file)
                 elif 0xc0 <= in_num <= 0xcf:
                     read_sof(in_num - 0xc0, input_file)
-                    if onlyMeta:
-                        return XYP
                 elif in_num == 0xda:
                     read_sos(input_file)
-                    bit_stream = bit_read(input_file)
-                    while not EOI:
-                        data.append(read_mcu())
-
-            in_char = input_file.read(1)
-        input_file.close()
-        if not inline_dc:
-            data = restore_dc(data)
-
-        #print("dequantify")
-        data = map(dequantify, data)
+                    bit_stream = input_file
+                    bitbuf = 0
+                    bitcnt = 0
+                    if not is_progressive:
+                        yield from decode_scan()
+                        in_num = next_marker(input_file)
+                        continue
+                    if not scans:
+                        init_coefficients()
+                    yield from decode_progressive_scan()
+                    scans += 1
+                    shown = False
+                    if scan_ss == 0 and not scan_ah and progressive and len(dc_comps) < len(component):
+                        dc_comps.extend(c for c in scan_comps if c not in dc_comps)
+                        if len(dc_comps) == len(component):
+                            show_dc(progressive)
+                            yield region(view[1], view[1] + view[3])
+                    if refine is True or refine and scans in refine:
+                        yield from show_coefficients()
+                        shown = True
+
+                in_num = next_marker(input_file)
+            if is_progressive and scans:
+                if not shown:
+                    yield from show_coefficients()
+                for comp in component.values():
+                    del comp['coef']
+        finally:
+            input_file.close()
         del huffman_ac_tables
         del huffman_dc_tables
-
-        #print("deserialize")
-        data = [for_each_du_in_mcu(mcu, zagzig) for mcu in data]
-
-        #print("inverse discrete cosine transform")
-        data = [for_each_du_in_mcu(mcu, idct) for mcu in data]
-        del idct_table
         del q_table
+        del input_file
         gc.collect()
 
-        #print("combine mcu")
-        data = show_all(data)
-        del data
-        del input_file
+    if profile:
+        # wrapped once per renderer, processFile reaches the wrapped
+        # functions through the closure. All IDCT variants are the idct stage,
+        # upsampling and conversion are color, the sink and store are output
+        next_marker = profile.wrap('parse', next_marker)
+        read_app = profile.wrap('parse', read_app)
+        read_dqt = profile.wrap('parse', read_dqt)
+        read_dnl = profile.wrap('parse', read_dnl)
+        read_dri = profile.wrap('parse', read_dri)
+        read_dht = profile.wrap('parse', read_dht)
+        read_sof = profile.wrap('parse', read_sof)
+        read_sos = profile.wrap('parse', read_sos)
+        read_mcu = profile.wrap('huffman', read_mcu)
+        decode_dc_first = profile.wrap('huffman', decode_dc_first)
+        decode_dc_refine = profile.wrap('huffman', decode_dc_refine)
+        decode_ac_first = profile.wrap('huffman', decode_ac_first)
+        decode_ac_refine = profile.wrap('huffman', decode_ac_refine)
+        dequantify = profile.wrap('dequantize', dequantify)
+        zagzig = profile.wrap('zigzag', zagzig)
+        idct = profile.wrap('idct', idct)
+        idct_scaled = profile.wrap('idct', idct_scaled)
+        idct_float = profile.wrap('idct', idct_float)
+        upsample = profile.wrap('color', upsample)
+        gather = profile.wrap('color', gather)
+        smooth = profile.wrap('color', smooth)
+        convert = profile.wrap('color', convert)
+        store = profile.wrap('output', store)
+        if blockcallback:
+            blockcallback = profile.wrap('output', blockcallback)
+        else:
+            callback = profile.wrap('output', callback)
 
-    class JPEGRenderer():
+    class JPEGRenderer(imgcache.Steps):
         def __init__(self):
             self.file = source
-            self.wasRendered = False
+            self.segments = None
+            self.info = None
+            self.steps = None
+
+        def probe(self):
+            if self.info is None:
+                self.info = probe(self.file, scale)
+            return self.info
 
         def getMeta(self):
-            return processFile(self.file, True)
+            info = self.probe()
+            return -(-info['width'] // scale), -(-info['height'] // scale), info['depth']
+
+        def setSource(self, source, sink=None):
+            # next image for the same decoder functions, tables and buffers
+            self.file = source
+            self.info = None
+            self.segments = None
+            if sink:
+                setSink(sink)
+            return self
+
+        def getSegments(self):
+            if self.segments is None:
+                self.segments = index_segments(self.file)
+            return self.segments
+
+        def getSegment(self):
+            return getSegment()
 
         def checkAndRender(self, w=False, h=False, wxh=False, **kwargs):
             X, Y, P = self.getMeta()
@@ -654,22 +1626,146 @@ def jpeg(source, quality=8, callback=print, cache=False):
                 return
             self.render(**kwargs)
 
-        @micropython.native
-        def render(self, x=0, y=0, placeholder=False, phcolor=0xBBBBBB):
+        def render(self, x=0, y=0, placeholder=False, phcolor=0xBBBBBB, progressive=False, refine=False, segments=None, crop=False):
+            for region in self.renderSteps(x, y, placeholder, phcolor, progressive, refine, segments, crop, 0):
+                pass
+            return self
+
+        def renderSteps(self, x=0, y=0, placeholder=False, phcolor=0xBBBBBB, progressive=False, refine=False, segments=None, crop=False, mcus=8):
+            # generator, decodes mcus MCUs per step and yields the screen
+            # region (x, y, w, h) drawn by them or None
             nonlocal rx, ry
+            # restart intervals of progressive scans are not separate parts
+            # of the image
+            if segments is not None and self.probe()['progressive']:
+                raise ValueError('Segments of a progressive JPEG')
+            if profile:
+                profile.start(self.file)
             rx = x
             ry = y
-            if not self.wasRendered:
-                if placeholder:
-                    W, H, P = self.getMeta()
-                    placeholder(x, y, W, H, phcolor)
-                processFile(self.file)
-                self.wasRendered = True
-            else:
-                if cached:
-                    showCached()
-                else:
-                    raise Exception('already rendered!')
-            return self
+            setProgressive(progressive, refine)
+            setSegments(segments, self.getSegments() if segments is not None else [])
+            setCrop(crop)
+            setStep(mcus)
+            k = None
+            if cache or placeholder:
+                X, Y, P = self.getMeta()
+                setView(X, Y)
+            # a subset of restart intervals is not a complete image
+            if cache and segments is None:
+                k = imgcache.key(self.file, 'jpeg', output_format, quality, fastidct, scale, fancy, view[:4])
+                img = imgcache.get(k)
+                if img:
+                    imgcache.show(img, x + view[0] - view[4], y + view[1] - view[5], callback, blockcallback)
+                    if profile:
+                        profile.end()
+                    yield x + view[0] - view[4], y + view[1] - view[5], view[2], view[3]
+                    return
+                startCache(view[2], view[3])
+            if placeholder:
+                placeholder(x + view[0] - view[4], y + view[1] - view[5], view[2], view[3], phcolor)
+            yield from processFile(self.file)
+            imgcache.put(k, cacheimg)
+            startCache(0, 0)
+            if profile:
+                profile.end()
 
     return JPEGRenderer()
+
+
+class JPEGDecoder():
+    # keeps one jpeg() renderer, so color tables, MCU planes, the data
+    # units of mcu_pool and the read buffer serve every decoded image
+    def __init__(self, **options):
+        self.renderer = jpeg(None, **options)
+
+    def decode(self, source, sink=None, x=0, y=0, **kwargs):
+        return self.renderer.setSource(source, sink).render(x, y, **kwargs)
+
+
+def probe(source, scale=1):
+    # reads the headers up to the frame header only, segments that don't
+    # fit into the buffer are skipped with seek
+    f = BlockReader(source, PROBE_SIZE)
+    try:
+        if f.word() != 0xFFD8:
+            raise ValueError('Not a JPEG file')
+        while True:
+            if f.byte() != 0xFF:
+                raise ValueError('Corrupted JPEG headers')
+            m = f.byte()
+            while m == 0xFF:
+                m = f.byte()
+            if m < 0:
+                raise ValueError('No frame header')
+            n = f.word()
+            if 0xC0 <= m <= 0xCF and m not in (0xC4, 0xC8, 0xCC):
+                break
+            f.seek(n - 2, 1)
+        buf = f.read(n - 2)
+    finally:
+        f.close()
+    P = buf[0]
+    Y = buf[1] << 8 | buf[2]
+    X = buf[3] << 8 | buf[4]
+    Nf = buf[5]
+    sampling = tuple((buf[7 + 3 * c] >> 4, buf[7 + 3 * c] & 0xF) for c in range(Nf))
+    Hmax = max(h for h, v in sampling)
+    Vmax = max(v for h, v in sampling)
+    # rough decoder RAM: tables, MCU coefficients and the MCU pixel buffer
+    # (array of samples per pixel), progressive images keep coefficients of
+    # all blocks
+    block = 8 // scale
+    ram = 4096 + 160 * sum(h * v for h, v in sampling) + 36 * block * block * Hmax * Vmax
+    progressive = m in (0xC2, 0xC6, 0xCA, 0xCE)
+    if progressive:
+        ram += 164 * -(-X // (8 * Hmax)) * -(-Y // (8 * Vmax)) * sum(h * v for h, v in sampling)
+    return {
+        'format': 'jpeg',
+        'width': X,
+        'height': Y,
+        'depth': P,
+        'color': Nf,
+        'interlace': False,
+        'progressive': progressive,
+        'sampling': sampling,
+        'ram': ram
+    }
+
+
+def render_parallel(source, x=0, y=0, workers=2, **kwargs):
+    # decodes restart intervals of a baseline JPEG on several threads, every
+    # thread has its own decoder instance and file handle, callbacks are
+    # called from all of them. Returns the renderer of the current thread,
+    # progressive images are decoded on the current thread only
+    import _thread
+    r = jpeg(source, **kwargs)
+    if workers < 2 or r.probe()['progressive']:
+        return r.render(x, y)
+    offsets = r.getSegments()
+    n = len(offsets)
+    if n < 2:
+        return r.render(x, y)
+    renderers = [r] + [jpeg(source, **kwargs) for i in range(1, workers)]
+    errors = []
+    done = []
+
+    def work(r, numbers, lock):
+        try:
+            r.render(x, y, segments=numbers)
+        except Exception as e:
+            errors.append(e)
+        lock.release()
+
+    for i in range(1, workers):
+        lock = _thread.allocate_lock()
+        lock.acquire()
+        done.append(lock)
+        renderers[i].segments = offsets
+        _thread.start_new_thread(work, (renderers[i], range(i, n, workers), lock))
+    renderers[0].render(x, y, segments=range(0, n, workers))
+    for lock in done:
+        lock.acquire()
+    if errors:
+        raise errors[0]
+    return renderers[0]
@@ -3,84 +3,166 @@
 
 import zlib
 from array import array
-from io import BytesIO
-
-
-def png(source, callback=print, cache=False, bg=(0, 0, 0), fastalpha=True):
+from io import IOBase
+import imgcache
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+# output pixel formats
+RGB888 = 0
+RGB565 = 1
+RGB565_LE = 2
+GS8 = 3
+MONO = 4
+
+# samples per pixel of every color type
+CHANNELS = (1, 0, 3, 1, 2, 0, 4)
+
+
+class BufferStream(IOBase):
+    # file-like access to bytes, bytearray, memoryview, mmap or any other
+    # buffer in place, read returns views of the buffer instead of copies
+    def __init__(self, source):
+        self.mv = memoryview(source)
+        self.pos = 0
+
+    def read(self, n=-1):
+        if n < 0:
+            n = len(self.mv) - self.pos
+        self.pos += n
+        return self.mv[self.pos - n:self.pos]
+
+    def readinto(self, buf):
+        n = max(0, min(len(buf), len(self.mv) - self.pos))
+        buf[:n] = self.mv[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.mv)
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+
+def png(source, callback=print, cache=False, bg=(0, 0, 0), fastalpha=True, blockcallback=None, output_format=RGB888, profile=None):
+    if output_format not in (RGB888, RGB565, RGB565_LE, GS8, MONO):
+        raise ValueError('Unknown output format')
     chunkSize = 0
     chunkType = 0
-    bpp = 4
-    channels = [1, 0, 3, 1, 2, 0, 4]
-    palette = []
+    channels = CHANNELS
+    palette = b''
+    trns = b''
+    # color key matched against raw samples of a row by maskKey
+    trnskey = b''
     WHDC = False
+    interlace = 0
     INT = int
     rx = 0
     ry = 0
     end = False
-    cached = array('i')
-    empty = array('b', [-1, -1, -1])
+    cacheimg = None
+    cached = bytearray(0)
+    cmask = bytearray(0)
+    rowbuf = bytearray(0)
+    # block of compressed data for native decompressors of multi-IDAT images
+    idatbuf = bytearray(512)
+    # current and previous scanline, kept for the next image
+    lines = bytearray(0)
+    colors = array('i')
+    lut = array('i')
+    pxbuf = rowbuf
+    progressive = False
+    crop = False
+    view = 0, 0, 0, 0, 0, 0
+    # scanlines between yields of incremental rendering, 0 to never yield
+    steprows = 0
+    # Adam7 passes: first x, first y, x step, y step, preview block width
+    # and height, the last entry describes a non-interlaced image
+    adam7 = bytes((0, 0, 8, 8, 8, 8,  4, 0, 8, 8, 4, 8,  0, 4, 4, 8, 4, 4,  2, 0, 4, 4, 2, 4,
+                   0, 2, 2, 4, 2, 2,  1, 0, 2, 2, 1, 2,  0, 1, 1, 2, 1, 1,  0, 0, 1, 1, 1, 1))
+    pxsize = (3, 2, 2, 1, 1)[output_format]
+    mono = output_format == MONO
+    bayer = bytes([8, 136, 40, 168, 200, 72, 232, 104, 56, 184, 24, 152, 248, 120, 216, 88])
 
     @micropython.viper
-    def rgb2int(RGBlist) -> int:
-        return (int(RGBlist[0]) << 0x10) + (int(RGBlist[1]) << 0x8) + int(RGBlist[2])
+    def rgb2int(r: int, g: int, b: int) -> int:
+        return (r << 0x10) + (g << 0x8) + b
 
     @micropython.viper
-    def parsePNG(src, onlymeta=False):
-        nonlocal end
+    def rgb_to_565(r: int, g: int, b: int) -> int:
+        return ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+
+    @micropython.viper
+    def rgb_to_565le(r: int, g: int, b: int) -> int:
+        c = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+        return ((c & 0xFF) << 8) | (c >> 8)
+
+    @micropython.viper
+    def rgb_to_gray(r: int, g: int, b: int) -> int:
+        return (r * 77 + g * 150 + b * 29) >> 8
+
+    @micropython.viper
+    def dither(x: int, y: int, c: int) -> int:
+        return 1 if c > int(bayer[((y & 3) << 2) | (x & 3)]) else 0
+
+    @micropython.viper
+    def put_px(buf, i: int, c: int):
+        p = ptr8(buf)
+        n = int(pxsize)
+        i *= n
+        while n > 0:
+            n -= 1
+            p[i + n] = c & 0xFF
+            c >>= 8
+
+    @micropython.native
+    def parsePNG(src):
+        # generator, yields regions drawn by readIDAT
         if isinstance(src, str):
             src = open(src, "rb")
-        elif isinstance(src, bytes):
-            src = BytesIO(src)
-        header = src.read(8)
-        if header != b'\x89\x50\x4e\x47\x0d\x0a\x1a\x0a':
-            return
-        while not end:
-            readChunkMeta(src)
-            readChunk(src)
-            if onlymeta:
-                return WHDC
-            src.seek(4, 1)
-        src.close()
+        elif not hasattr(src, 'readinto'):
+            src = BufferStream(src)
+        if profile and not isinstance(src, BufferStream):
+            src = profile.reader(src)
+        try:
+            header = bytes(src.read(8))
+            if header != b'\x89\x50\x4e\x47\x0d\x0a\x1a\x0a':
+                return
+            while not end:
+                readChunkMeta(src)
+                if chunkType == b'IDAT':
+                    yield from readIDAT(src)
+                else:
+                    readChunk(src)
+                src.seek(4, 1)
+        finally:
+            src.close()
 
     @micropython.native
     def readChunkMeta(src):
         nonlocal chunkSize, chunkType
         chunkSize = bint(src.read(4))
-        chunkType = src.read(4)
+        chunkType = bytes(src.read(4))
 
     @micropython.viper
     def bint(inp) -> int:
         return int(INT.from_bytes(inp, 'big'))
 
-    @micropython.native
-    def truediv(a, b):
-        return a / b
-
-    @micropython.viper
-    def rgba2rgb(r: int, g: int, b: int, a: int):
-        if fastalpha:
-            return [r, g, b] if a != 0 else empty
-        if a == 0:
-            return empty
-        fr = float(r)
-        fg = float(g)
-        fb = float(b)
-        fa = float(truediv(a, 255))
-        R = round(fr * fa + (1.0 - fa) * float(bg[0]))
-        G = round(fg * fa + (1.0 - fa) * float(bg[1]))
-        B = round(fb * fa + (1.0 - fa) * float(bg[2]))
-        return R, G, B
-
     @micropython.viper
     def readChunk(src):
-        supported = {
-            b'IHDR': readIHDR,
-            b'PLTE': readPLTE,
-            b'IDAT': readIDAT,
-            b'IEND': readIEND
-        }
-        if chunkType in supported:
-            supported[chunkType](src)
+        if chunkType in readers:
+            readers[chunkType](src)
         else:
             src.seek(chunkSize, 1)
 
@@ -91,32 +173,26 @@ def png(source, callback=print, cache=False, bg=(0, 0, 0), fastalpha=True):
 
     @micropython.native
     def readIHDR(src):
-        nonlocal WHDC
+        nonlocal WHDC, interlace
         WHDC = tuple(map(bint, (src.read(4), src.read(4), src.read(1), src.read(1))))
-        src.seek(3, 1)
+        src.seek(2, 1)
+        interlace = bint(src.read(1))
 
     @micropython.native
     def readPLTE(src):
         nonlocal palette
-        for i in range(round(chunkSize // 3)):
-            palette.append(src.read(3))
+        palette = src.read(chunkSize)
 
     @micropython.native
-    def getRealBpp(c, d, w):
-        rbpp = c * d / 8
-        bp = round(rbpp)
-        br = round(rbpp * w)
-        return (br, bp)
-
-    @micropython.viper
-    def getSlicedItem(item, start, end):
-        return item[start:end]
+    def readTRNS(src):
+        nonlocal trns
+        trns = bytes(src.read(chunkSize))
 
     @micropython.native
-    def setBpp(value):
-        nonlocal bpp
-        bpp = value
-        return bpp
+    def getRealBpp(c, d, w):
+        bp = (c * d + 7) // 8
+        br = (c * d * w + 7) // 8
+        return (br, bp)
 
     @micropython.native
     def setChunkSize(value):
@@ -124,168 +200,651 @@ def png(source, callback=print, cache=False, bg=(0, 0, 0), fastalpha=True):
         chunkSize = value
         return chunkSize
 
+    @micropython.native
+    def startCache(w, h, c):
+        nonlocal cacheimg, cached, cmask
+        transparent = c == 4 or c == 6 or len(trns) > 0
+        cacheimg = imgcache.new(w, h, pxsize, transparent)
+        cached = cacheimg.data if cacheimg else bytearray(0)
+        cmask = cacheimg.mask if cacheimg and transparent else bytearray(0)
+
     @micropython.viper
-    def show(x, y, c: int):
-        if cache:
-            cached.append(c)
-        if c >= 0:
-            callback(x, y, c)
+    def cachePx(i: int, c: int, t: int):
+        # transparent pixels are stored with bg color and flagged in the mask
+        put_px(cached, i, c)
+        if t:
+            m = ptr8(cmask)
+            m[i >> 3] = m[i >> 3] | (1 << (i & 7))
 
     @micropython.viper
-    def readIDAT(src):
-        isNextChunkIDAT = True
-        fullchunk = b''
-        while isNextChunkIDAT:
-            fullchunk += src.read(chunkSize)
-            src.seek(4, 1)
-            nextSize = bint(src.read(4))
-            isNextChunkIDAT = bool(src.read(4) == b'IDAT')
-            if not isNextChunkIDAT:
-                src.seek(12 * -1, 1)
+    def showRow(y: int, a: int, s: int, w: int):
+        # colors[i] holds the pixel at image column a + i, w pixels from
+        # index s are inside the view
+        o = ptr32(colors)
+        ox = int(rx) - int(view[4]) + a
+        oy = int(ry) + y - int(view[5])
+        n = (y - int(view[1])) * int(view[2]) + a - int(view[0])
+        bgc = int(bgclr)
+        for x in range(s, s + w):
+            c = o[x]
+            t = c >> 24  # -1, transparent pixel
+            if t:
+                if not cached:
+                    continue
+                c = bgc
+            if mono:
+                c = int(dither(a + x, y, c))
+            if cached:
+                cachePx(n + x, c, t)
+            if not t:
+                callback(ox + x, oy, c)
+
+    @micropython.viper
+    def storeRow(y: int, a: int, s: int, w: int):
+        o = ptr32(colors)
+        p = ptr8(rowbuf)
+        n = int(pxsize)
+        bgc = int(bgclr)
+        ci = (y - int(view[1])) * int(view[2]) - s
+        for x in range(s, s + w):
+            c = o[x]
+            t = c >> 24  # -1, transparent pixel
+            if t:
+                c = bgc
+            if mono:
+                c = int(dither(a + x, y, c))
+            if cached:
+                cachePx(ci + x, c, t)
+            i = (x - s) * n
+            if n == 3:
+                p[i] = (c >> 16) & 0xFF
+                p[i + 1] = (c >> 8) & 0xFF
+                p[i + 2] = c & 0xFF
+            elif n == 2:
+                p[i] = (c >> 8) & 0xFF
+                p[i + 1] = c & 0xFF
+            else:
+                p[i] = c & 0xFF
+
+    @micropython.viper
+    def showPassRow(y: int, w: int, x0: int, dx: int):
+        # emits pixels of one row of an Adam7 pass that are inside the view
+        # at their final positions, blockcallback gets 1x1 blocks unless
+        # the pass covers whole rows, or nothing if the image is cached,
+        # then showCachedRow passes complete rows
+        o = ptr32(colors)
+        held = 0
+        if blockcallback and cached:
+            held = 1
+        cx = int(view[0])
+        cy = int(view[1])
+        cw = int(view[2])
+        ox = int(rx) - int(view[4])
+        oy = int(ry) + y - int(view[5])
+        n = (y - cy) * cw - cx
+        i0 = 0
+        if cx > x0:
+            i0 = (cx - x0 + dx - 1) // dx
+        i1 = (cx + cw - x0 + dx - 1) // dx
+        if i1 > w:
+            i1 = w
+        for i in range(i0, i1):
+            x = x0 + i * dx
+            c = o[i]
+            t = c >> 24  # -1, transparent pixel
+            if t:
+                if not blockcallback and not cached:
+                    continue
+                c = int(bgclr)
+            if mono:
+                c = int(dither(x, y, c))
+            if cached:
+                cachePx(n + x, c, t)
+            if not blockcallback:
+                if not t:
+                    callback(ox + x, oy, c)
+            elif held:
+                continue
+            elif dx == 1:
+                put_px(rowbuf, x - cx, c)
+            else:
+                put_px(pxbuf, 0, c)
+                blockcallback(ox + x, oy, 1, 1, pxbuf)
+        if blockcallback and dx == 1 and not held:
+            blockcallback(ox + cx, oy, cw, 1, rowbuf)
+
+    @micropython.native
+    def lastPass(W, y):
+        # last Adam7 pass with pixels in row y
+        a = adam7
+        for p in range(6, 0, -1):
+            if W > a[p * 6] and y % a[p * 6 + 3] == a[p * 6 + 1]:
+                return p
+        return 0
+
+    @micropython.native
+    def showCachedRow(y):
+        # an interlaced row held in the cache image, once it is complete
+        cw = view[2]
+        size = cw * pxsize
+        i = (y - view[1]) * size
+        blockcallback(rx + view[0] - view[4], ry + y - view[5], cw, 1, memoryview(cached)[i:i + size])
+
+    @micropython.viper
+    def fillPassRow(y: int, w: int, p: int):
+        # progressive mode, draws every pixel of an Adam7 pass row as a block
+        # covering the area not yet decoded (clipped to the view), later
+        # passes refine it
+        o = ptr32(colors)
+        a = ptr8(adam7)
+        cx = int(view[0])
+        cy = int(view[1])
+        cw = int(view[2])
+        ch = int(view[3])
+        x0 = a[p * 6]
+        dx = a[p * 6 + 2]
+        by = y
+        bh = a[p * 6 + 5]
+        if by < cy:
+            bh -= cy - by
+            by = cy
+        if by + bh > cy + ch:
+            bh = cy + ch - by
+        if bh <= 0:
+            return
+        ox = int(rx) - int(view[4])
+        oy = int(ry) - int(view[5])
+        n = (y - cy) * cw - cx
+        for i in range(w):
+            x = x0 + i * dx
+            bx = x
+            bw = a[p * 6 + 4]
+            if bx < cx:
+                bw -= cx - bx
+                bx = cx
+            if bx + bw > cx + cw:
+                bw = cx + cw - bx
+            if bw <= 0:
+                continue
+            c = o[i]
+            t = c >> 24
+            if t:  # -1, transparent pixel
+                c = int(bgclr)
+            if mono:
+                c = int(dither(x, y, c))
+            if cached and bx == x and y >= cy and y < cy + ch:
+                cachePx(n + x, c, t)
+            progressive(ox + bx, oy + by, bw, bh, c)
+
+    @micropython.native
+    def nextIDAT(src):
+        src.seek(4, 1)
+        nextSize = bint(src.read(4))
+        if bytes(src.read(4)) == b'IDAT':
             setChunkSize(nextSize)  #chunkSize = nextSize
-        idat = zlib.decompress(fullchunk)
-        idat = BytesIO(idat)
+            return True
+        src.seek(12 * -1, 1)
+        return False
+
+    class IDATStream(IOBase):
+        # compressed image data spread over consecutive IDAT chunks
+        def __init__(self, src):
+            self.src = src
+            self.end = src.tell() + chunkSize
+            self.pos = 0  # next byte and end of the data in idatbuf
+            self.size = 0
+
+        def readinto(self, buf):
+            # native decompressors read one byte at a time, they are served
+            # from blocks of chunk data read into the reused idatbuf
+            if self.pos >= self.size:
+                left = self.end - self.src.tell()
+                while not left:
+                    if not nextIDAT(self.src):
+                        return 0
+                    left = chunkSize
+                    self.end = self.src.tell() + left
+                if left >= len(idatbuf):
+                    self.size = self.src.readinto(idatbuf) or 0
+                else:
+                    self.size = self.src.readinto(memoryview(idatbuf)[:left]) or 0
+                self.pos = 0
+            n = min(len(buf), self.size - self.pos)
+            if n == 1:
+                buf[0] = idatbuf[self.pos]
+            else:
+                buf[:n] = memoryview(idatbuf)[self.pos:self.pos + n]
+            self.pos += n
+            return n
+
+        def read(self, n):
+            # up to n bytes of the current chunk, views of buffer sources
+            left = self.end - self.src.tell()
+            while not left:
+                if not nextIDAT(self.src):
+                    return b''
+                left = chunkSize
+                self.end = self.src.tell() + left
+            return self.src.read(min(n, left))
+
+        def skip(self):
+            self.src.seek(self.end)
+            while nextIDAT(self.src):
+                self.src.seek(chunkSize, 1)
+
+    class Inflater():
+        # incremental zlib reader for ports with zlib.decompressobj (CPython)
+        def __init__(self, stream):
+            self.stream = stream
+            self.zobj = zlib.decompressobj()
+
+        def readinto(self, buf):
+            got = 0
+            size = len(buf)
+            while got < size:
+                data = self.zobj.unconsumed_tail
+                if not data:
+                    data = self.stream.read(1024)
+                    if not data:
+                        break
+                out = self.zobj.decompress(data, size - got)
+                buf[got:got + len(out)] = out
+                got += len(out)
+            return got
+
+    @micropython.native
+    def inflate(src, stream):
+        if hasattr(zlib, 'decompressobj'):
+            return Inflater(stream)
+        # native decompressors read one byte at a time, so a single IDAT
+        # chunk is read straight from the file instead of through IDATStream
+        src.seek(chunkSize + 4, 1)
+        single = bytes(src.read(8)[4:]) != b'IDAT'
+        src.seek(stream.end)
+        src.seek(-chunkSize, 1)
+        if deflate:
+            return deflate.DeflateIO(src if single else stream, deflate.ZLIB)
+        return zlib.DecompIO(src if single else stream)
+
+    @micropython.native
+    def setView(W, H):
+        nonlocal view
+        view = imgcache.view(crop, W, H)
+
+    @micropython.native
+    def readIDAT(src):
+        # generator, yields the region drawn by every steprows scanlines
+        nonlocal rowbuf, pxbuf, lines
+        stream = IDATStream(src)
+        idat = inflate(src, stream)
         W = int(WHDC[0])
         H = int(WHDC[1])
         D = int(WHDC[2])
         C = int(WHDC[3])
-        bToRead, obpp = getRealBpp(channels[C], D, W)
-        bpp = int(setBpp(obpp))  #bpp = int(obpp)
-        prevrow = b''
-        andbits = ((1 << D) - 1)
-        for y in range(H):
-            ftype = bint(idat.read(1))
-            row = idat.read(int(bToRead))
-            row = applyFilter(ftype, row, y, prevrow)
-            for x in range(W):
-                if D >= 8:
-                    clr = rgb2int(
-                        readColor(
-                            getSlicedItem(row,
-                                          int(x) * int(bpp),
-                                          int(x) * int(bpp) + int(bpp)), D, C))
-                else:
-                    bpb = int(8 // D)
-                    realx = (x // bpb +
-                             1 * int(x % bpb != 0)) - 1 * int(x != 0)
-                    clrB = getSlicedItem(row, realx, realx + 1)
-                    idx = int(x == 0) + x % bpb or bpb
-                    clrI = int(clrB[0]) >> (8 - D * idx) & andbits
-                    #gets needed bits from a byte^
-                    clr = rgb2int(readColor(clrI, D, C))
-                show(int(rx) + x, int(ry) + y, clr)
-            prevrow = row
+        setView(W, H)
+        cx = int(view[0])
+        cy = int(view[1])
+        cw = int(view[2])
+        ch = int(view[3])
+        convert = getConverter(C, D, W)
+        readLine = idat.readinto
+        if profile:
+            convert = profile.wrap('convert', convert)
+            readLine = profile.wrap('inflate', readLine)
+        if blockcallback and int(len(rowbuf)) != cw * int(pxsize):
+            rowbuf = bytearray(cw * int(pxsize))
+            pxbuf = memoryview(rowbuf)[:int(pxsize)]
+        full = int(getRealBpp(channels[C], D, W)[0]) + 1
+        if int(len(lines)) < 2 * full:
+            lines = bytearray(2 * full)
+        first = 7
+        last = 8
+        if interlace:
+            # pixels of every pass are emitted at their final positions
+            first = 0
+            last = 7
+        if cache:
+            startCache(cw, ch, C)
+        # non-interlaced rows are converted from the first byte holding a
+        # pixel of the view, column ca
+        bits = int(channels[C]) * D
+        ca = cx
+        skip = cx * (bits >> 3)
+        if bits < 8:
+            ca = cx - cx % (8 // bits)
+            skip = ca * bits >> 3
+        a = adam7
+        # image rows drawn since the last yield and scanlines read
+        top = H
+        bottom = 0
+        n = 0
+        for p in range(first, last):
+            x0 = a[p * 6]
+            y0 = a[p * 6 + 1]
+            dx = a[p * 6 + 2]
+            dy = a[p * 6 + 3]
+            w = (W - x0 + dx - 1) // dx
+            h = (H - y0 + dy - 1) // dy
+            if w <= 0 or h <= 0:
+                continue  # empty passes have no scanlines at all
+            bToRead, obpp = getRealBpp(channels[C], D, w)
+            bpp = int(obpp)
+            scanline = memoryview(lines)[:int(bToRead) + 1]
+            prevline = memoryview(lines)[full:full + int(bToRead) + 1]
+            clearLine(prevline, int(bToRead) + 1)
+            row = memoryview(scanline)[1:]
+            prevrow = memoryview(prevline)[1:]
+            if not interlace:
+                row = memoryview(scanline)[1 + skip:]
+                prevrow = memoryview(prevline)[1 + skip:]
+            for j in range(h):
+                y = y0 + j * dy
+                if y >= cy + ch and p >= 6:
+                    break  # rows below the view are not inflated at all
+                readLine(scanline)
+                applyFilter(scanline, prevline, bToRead, bpp)
+                if interlace:
+                    if progressive and p < 6:
+                        if y < cy + ch:
+                            convert(row, w)
+                            fillPassRow(y, w, p)
+                            top = min(top, y)
+                            bottom = max(bottom, y + a[p * 6 + 5])
+                    elif y >= cy and y < cy + ch:
+                        convert(row, w)
+                        showPassRow(y, w, x0, dx)
+                        if blockcallback and cached and p == lastPass(W, y):
+                            showCachedRow(y)
+                        top = min(top, y)
+                        bottom = max(bottom, y + 1)
+                elif y >= cy:
+                    convert(row, cx - ca + cw)
+                    if blockcallback:
+                        storeRow(y, ca, cx - ca, cw)
+                        blockcallback(int(rx) + cx - int(view[4]), int(ry) + y - int(view[5]), cw, 1, rowbuf)
+                    else:
+                        showRow(y, ca, cx - ca, cw)
+                    top = min(top, y)
+                    bottom = y + 1
+                scanline, prevline = prevline, scanline
+                row, prevrow = prevrow, row
+                n += 1
+                if n == steprows:
+                    yield region(top, bottom)
+                    top = H
+                    bottom = 0
+                    n = 0
+        stream.skip()
+        if bottom:
+            yield region(top, bottom)
+
+    @micropython.native
+    def region(top, bottom):
+        return imgcache.region(view, rx, ry, top, bottom)
 
     @micropython.viper
-    def readColor(src, depth: int, colormode: int):
-        if colormode == 3:
-            if not isinstance(src, INT):
-                x = int(src[0])
-            else:
-                x = int(src)
-            r, g, b = palette[x]
-            return (r, g, b)
-        if colormode == 0:
-            if depth <= 4:
-                maxClr = (1 << depth) - 1
-                clr = round(int(src) * 255 // maxClr)
-                return (clr, clr, clr)
-            if depth == 8:
-                gs = src
-                return (gs, gs, gs)
-            if depth == 16:
-                gs, a = src
-                return rgba2rgb(gs, gs, gs, a)
-        if colormode == 4:
-            if depth == 8:
-                gs, a = src
-            if depth == 16:
-                gs, gs2, a, a2 = src
-            return rgba2rgb(gs, gs, gs, a)
-        if colormode == 2:
-            if depth == 8:
-                r, g, b = src
-            if depth == 16:
-                r, r2, g, g2, b, b2 = src
-            return (r, g, b)
-        if colormode == 6:
-            if depth == 8:
-                r, g, b, a = src
-            if depth == 16:
-                r, r2, g, g2, b, b2, a, a2 = src
-            return rgba2rgb(r, g, b, a)
+    def clearLine(buf, n: int):
+        p = ptr8(buf)
+        for i in range(n):
+            p[i] = 0
 
-    @micropython.native
-    def applyFilter(f, row, y, prevrow):
-        @micropython.viper
-        def PaethPredictor(a: int, b: int, c: int) -> int:
-            p = a + b - c
-            pa = abs(p - a)
-            pb = abs(p - b)
-            pc = abs(p - c)
-            if pa <= pb and pa <= pc:
-                Pr = a
-            elif pb <= pc:
-                Pr = b
-            else:
-                Pr = c
-            return Pr
+    @micropython.viper
+    def unpackSamples(row, w: int, d: int):
+        r = ptr8(row)
+        o = ptr32(colors)
+        if d >= 8:
+            s = d >> 3
+            for x in range(w):
+                o[x] = r[x * s]
+            return
+        mask = (1 << d) - 1
+        x = 0
+        i = 0
+        while x < w:
+            v = r[i]
+            i += 1
+            shift = 8 - d
+            while shift >= 0 and x < w:
+                o[x] = (v >> shift) & mask
+                x += 1
+                shift -= d
 
-        @micropython.native
-        def ReconA(c: int) -> int:
-            return out[c - int(bpp)] if c >= int(bpp) else 0
+    @micropython.viper
+    def mapLut(w: int):
+        o = ptr32(colors)
+        l = ptr32(lut)
+        for x in range(w):
+            o[x] = l[o[x]]
+
+    @micropython.viper
+    def maskKey(row, w: int, n: int):
+        # marks pixels matching the tRNS color key as transparent
+        r = ptr8(row)
+        o = ptr32(colors)
+        k = ptr8(trnskey)
+        for x in range(w):
+            i = x * n
+            j = 0
+            while j < n and r[i + j] == k[j]:
+                j += 1
+            if j == n:
+                o[x] = -1
 
-        @micropython.native
-        def ReconB(r: int, c: int) -> int:
-            return prevrow[c] if r > 0 else 0
+    @micropython.viper
+    def convertRGB(row, w: int, s: int):
+        r = ptr8(row)
+        o = ptr32(colors)
+        i = 0
+        for x in range(w):
+            o[x] = int(pack(r[i], r[i + s], r[i + 2 * s]))
+            i += 3 * s
 
-        @micropython.native
-        def ReconC(r: int, c: int) -> int:
-            return prevrow[c - int(bpp)] if r > 0 and c >= int(bpp) else 0
+    @micropython.viper
+    def blendColor(r: int, g: int, b: int, a: int) -> int:
+        if a == 0:
+            return -1
+        if a != 255 and not fastalpha:
+            r = (r * a + int(bg[0]) * (255 - a) + 127) // 255
+            g = (g * a + int(bg[1]) * (255 - a) + 127) // 255
+            b = (b * a + int(bg[2]) * (255 - a) + 127) // 255
+        return int(pack(r, g, b))
 
-        @micropython.viper
-        def f0(x, r, c):
-            return x
+    @micropython.viper
+    def convertAlpha(row, w: int, s: int, gray: int):
+        r = ptr8(row)
+        o = ptr32(colors)
+        n = 2 * s if gray else 4 * s
+        i = 0
+        for x in range(w):
+            R = r[i]
+            if gray:
+                G = R
+                B = R
+                A = r[i + s]
+            else:
+                G = r[i + s]
+                B = r[i + 2 * s]
+                A = r[i + 3 * s]
+            i += n
+            if A == 255:
+                o[x] = int(pack(R, G, B))
+            else:
+                o[x] = int(blendColor(R, G, B, A))
 
-        @micropython.viper
-        def f1(x, r, c) -> int:
-            return int(x + ReconA(c))
+    @micropython.native
+    def getConverter(C, D, W):
+        nonlocal colors, lut, trnskey
+        # picks the row converter for this color type and bit depth once,
+        # converters write output colors (-1 for transparent) to colors
+        if len(colors) < W:
+            colors = array('i', range(W))
+        S = 2 if D == 16 else 1
+        if C == 2:
+            if not trns:
+                return lambda row, w: convertRGB(row, w, S)
+            # 8-bit samples are compared with the low bytes of the key
+            trnskey = bytes((trns[1], trns[3], trns[5])) if S == 1 else trns
+            def convertKeyedRGB(row, w):
+                convertRGB(row, w, S)
+                maskKey(row, w, 3 * S)
+            return convertKeyedRGB
+        if C == 4 or C == 6:
+            return lambda row, w: convertAlpha(row, w, S, C == 4)
+        # palette indices and gray samples are mapped through a table of
+        # final output colors, built once per image
+        levels = 1 << min(D, 8)
+        if len(lut) != levels:
+            lut = array('i', range(levels))
+        for v in range(levels):
+            if C == 3:
+                if 3 * v + 2 < len(palette):
+                    a = trns[v] if v < len(trns) else 255
+                    lut[v] = blendColor(palette[3 * v], palette[3 * v + 1], palette[3 * v + 2], a)
+                else:
+                    lut[v] = pack(0, 0, 0)
+            else:
+                g = v * 255 // (levels - 1)
+                lut[v] = pack(g, g, g)
+        if C == 0 and trns and D <= 8:
+            key = bint(trns[:2])
+            if key < levels:
+                lut[key] = -1
+        def convertIndexed(row, w):
+            unpackSamples(row, w, D)
+            mapLut(w)
+            if C == 0 and trns and D == 16:
+                maskKey(row, w, 2)
+        trnskey = trns
+        return convertIndexed
 
-        @micropython.viper
-        def f2(x, r, c) -> int:
-            return int(x + ReconB(r, c))
+    @micropython.viper
+    def filterSub(cur, prev, n: int, bpp: int):
+        c = ptr8(cur)
+        for i in range(1 + bpp, n + 1):
+            c[i] = (c[i] + c[i - bpp]) & 0xFF
 
-        @micropython.viper
-        def f3(x: int, r, c) -> int:
-            return int(x + int(ReconA(c) + ReconB(r, c)) // 2)
+    @micropython.viper
+    def filterUp(cur, prev, n: int, bpp: int):
+        c = ptr8(cur)
+        p = ptr8(prev)
+        for i in range(1, n + 1):
+            c[i] = (c[i] + p[i]) & 0xFF
 
-        @micropython.viper
-        def f4(x: int, r, c) -> int:
-            return x + int(PaethPredictor(ReconA(c), ReconB(r, c), ReconC(r, c)))
+    @micropython.viper
+    def filterAverage(cur, prev, n: int, bpp: int):
+        c = ptr8(cur)
+        p = ptr8(prev)
+        for i in range(1, 1 + bpp):
+            c[i] = (c[i] + (p[i] >> 1)) & 0xFF
+        for i in range(1 + bpp, n + 1):
+            c[i] = (c[i] + ((c[i - bpp] + p[i]) >> 1)) & 0xFF
 
-        ftypes = [f0, f1, f2, f3, f4]
-        out = array('B')
-        if f >= 0 and f < 5:
-            for i in range(len(row)):
-                out.append(ftypes[f](row[i], y, i) & 0xFF)
-        return out
+    @micropython.viper
+    def filterPaeth(cur, prev, n: int, bpp: int):
+        c = ptr8(cur)
+        p = ptr8(prev)
+        for i in range(1, 1 + bpp):
+            c[i] = (c[i] + p[i]) & 0xFF
+        for i in range(1 + bpp, n + 1):
+            a = c[i - bpp]
+            b = p[i]
+            ab = p[i - bpp]
+            pa = b - ab
+            pb = a - ab
+            pc = pa + pb
+            if pa < 0:
+                pa = 0 - pa
+            if pb < 0:
+                pb = 0 - pb
+            if pc < 0:
+                pc = 0 - pc
+            if pa <= pb and pa <= pc:
+                pr = a
+            elif pb <= pc:
+                pr = b
+            else:
+                pr = ab
+            c[i] = (c[i] + pr) & 0xFF
 
     @micropython.native
-    def showCached():
-        i = 0
-        W, H, D, C = WHDC
-        for y in range(H):
-            for x in range(W):
-                if cached[i] >= 0:
-                    callback(rx + x, ry + y, cached[i])
-                i += 1
-
-    class PNGRenderer():
+    def applyFilter(cur, prev, n, bpp):
+        # cur and prev hold the filter type byte followed by n row bytes,
+        # the row is unfiltered in place
+        f = cur[0]
+        if f == 1:
+            filterSub(cur, prev, n, bpp)
+        elif f == 2:
+            filterUp(cur, prev, n, bpp)
+        elif f == 3:
+            filterAverage(cur, prev, n, bpp)
+        elif f == 4:
+            filterPaeth(cur, prev, n, bpp)
+
+    def setProgressive(fill):
+        nonlocal progressive
+        progressive = fill
+
+    def setCrop(region):
+        nonlocal crop
+        crop = region
+
+    def setStep(rows):
+        nonlocal steprows
+        steprows = rows
+
+    def setSink(sink):
+        nonlocal callback, blockcallback
+        if profile:
+            sink = profile.wrap('output', sink)
+        if blockcallback:
+            blockcallback = sink
+        else:
+            callback = sink
+
+    if profile:
+        # convert and readLine depend on the image and are wrapped in
+        # readIDAT. The output stage is the sink itself (and storeRow), the
+        # row functions calling it are not timed, so it is counted once
+        readChunkMeta = profile.wrap('parse', readChunkMeta)
+        readChunk = profile.wrap('parse', readChunk)
+        applyFilter = profile.wrap('unfilter', applyFilter)
+        storeRow = profile.wrap('output', storeRow)
+        if blockcallback:
+            blockcallback = profile.wrap('output', blockcallback)
+        else:
+            callback = profile.wrap('output', callback)
+
+    readers = {
+        b'IHDR': readIHDR,
+        b'PLTE': readPLTE,
+        b'tRNS': readTRNS,
+        b'IEND': readIEND
+    }
+    pack = (rgb2int, rgb_to_565, rgb_to_565le, rgb_to_gray, rgb_to_gray)[output_format]
+    bgclr = pack(bg[0], bg[1], bg[2])
+
+    class PNGRenderer(imgcache.Steps):
         def __init__(self):
             self.file = source
+            self.info = None
+            self.steps = None
+
+        def probe(self):
+            if self.info is None:
+                self.info = probe(self.file)
+            return self.info
 
         def getMeta(self):
-            return WHDC or parsePNG(self.file, True)
+            info = self.probe()
+            return info['width'], info['height'], info['depth'], info['color']
+
+        def setSource(self, source, sink=None):
+            # next image for the same decoder functions, tables and buffers
+            self.file = source
+            self.info = None
+            if sink:
+                setSink(sink)
+            return self
 
         def checkAndRender(self, w=False, h=False, wxh=False, **kwargs):
             W, H, D, C = self.getMeta()
@@ -297,20 +856,92 @@ def png(source, callback=print, cache=False, bg=(0, 0, 0), fastalpha=True):
                 return
             self.render(**kwargs)
 
-        @micropython.native
-        def render(self, x=0, y=0, placeholder=False, phcolor=0xBBBBBB):
-            nonlocal rx, ry, end, palette
+        def render(self, x=0, y=0, placeholder=False, phcolor=0xBBBBBB, progressive=False, crop=False):
+            for region in self.renderSteps(x, y, placeholder, phcolor, progressive, crop, 0):
+                pass
+            return self
+
+        def renderSteps(self, x=0, y=0, placeholder=False, phcolor=0xBBBBBB, progressive=False, crop=False, rows=8):
+            # generator, decodes rows scanlines per step and yields the screen
+            # region (x, y, w, h) drawn by them or None
+            nonlocal rx, ry, end, palette, trns, cacheimg
+            if profile:
+                profile.start(self.file)
             rx = x
             ry = y
-            if not cached:
-                palette = []
-                end = False
-                if placeholder:
-                    W, H, D, C = self.getMeta()
-                    placeholder(x, y, W, H, phcolor)
-                parsePNG(self.file, False)
-            else:
-                showCached()
-            return self
+            setProgressive(progressive)
+            setCrop(crop)
+            setStep(rows)
+            k = None
+            if cache or placeholder:
+                W, H, D, C = self.getMeta()
+                setView(W, H)
+            if cache:
+                k = imgcache.key(self.file, 'png', output_format, bg, fastalpha, view[:4])
+                img = imgcache.get(k)
+                if img:
+                    imgcache.show(img, x + view[0] - view[4], y + view[1] - view[5], callback, blockcallback)
+                    if profile:
+                        profile.end()
+                    yield x + view[0] - view[4], y + view[1] - view[5], view[2], view[3]
+                    return
+            palette = b''
+            trns = b''
+            end = False
+            if placeholder:
+                placeholder(x + view[0] - view[4], y + view[1] - view[5], view[2], view[3], phcolor)
+            yield from parsePNG(self.file)
+            imgcache.put(k, cacheimg)
+            cacheimg = None
+            startCache(0, 0, 0)
+            if profile:
+                profile.end()
 
     return PNGRenderer()
+
+
+class PNGDecoder():
+    # one png() renderer for a stream of images, its scanline, row and IDAT
+    # buffers are kept between them
+    def __init__(self, **options):
+        self.renderer = png(None, **options)
+
+    def decode(self, source, sink=None, x=0, y=0, **kwargs):
+        return self.renderer.setSource(source, sink).render(x, y, **kwargs)
+
+
+def probe(source):
+    # signature and IHDR are the first 33 bytes of every PNG file
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            buf = f.read(33)
+    elif hasattr(source, 'readinto'):
+        # open files are read from and left at their position
+        pos = source.tell()
+        buf = bytes(source.read(33))
+        source.seek(pos)
+    else:
+        buf = bytes(source[:33])
+    if buf[:8] != b'\x89\x50\x4e\x47\x0d\x0a\x1a\x0a' or buf[12:16] != b'IHDR':
+        raise ValueError('Not a PNG file')
+    W = int.from_bytes(buf[16:20], 'big')
+    H = int.from_bytes(buf[20:24], 'big')
+    D = buf[24]
+    C = buf[25]
+    interlace = buf[28] == 1
+    # rough decoder RAM: inflate window, two scanlines, a row of output
+    # colors and the color table of palette and gray images
+    ram = 32768 + 2 * ((CHANNELS[C] * D * W + 7) // 8 + 1) + 4 * W
+    if C == 0 or C == 3:
+        ram += 4 << min(D, 8)
+    return {
+        'format': 'png',
+        'width': W,
+        'height': H,
+        'depth': D,
+        'color': C,
+        'interlace': interlace,
+        'progressive': interlace,
+        'sampling': None,
+        'ram': ram
+    }
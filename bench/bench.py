@@ -0,0 +1,173 @@
+# decoder benchmark over the corpus written by corpus.py, runs on the
+# MicroPython unix port and on CPython (with shim.py):
+#   python3 bench/bench.py [name filter]
+#   micropython bench/bench.py [name filter]
+# For every image: decode time, time per megapixel, time to first pixel,
+# callback calls, peak heap, bytes allocated and the difference from the
+# expected output in corpus/<name>.rgba. CPython has no count of bytes
+# allocated (tracemalloc only tells the peak), so there is no alloc column
+
+import gc
+import os
+import sys
+try:
+    import micropython
+except ImportError:
+    import shim
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DIR = __file__.rsplit('/', 1)[0] if '/' in __file__ else '.'
+CORPUS = DIR + '/corpus'
+sys.path.append(DIR + '/..')
+
+from PNGdecoder import png
+from JPEGdecoder import jpeg
+
+# lowest PSNR (dB) of a JPEG decode against the corpus source pixels
+MIN_PSNR = 30
+
+
+def renderer(path, callback):
+    if path.endswith('.png'):
+        return png(path, callback=callback, fastalpha=False, bg=(0, 0, 0))
+    return jpeg(path, callback=callback)
+
+
+def timed(path, w, h):
+    # decodes into an RGBA frame, returns it with microseconds to the end
+    # and to the first pixel and the number of callback calls
+    out = bytearray(w * h * 4)
+    state = [0, 0]
+
+    def pixel(x, y, c):
+        if not state[0]:
+            state[1] = ticks_us()
+        state[0] += 1
+        i = (y * w + x) * 4
+        out[i] = c >> 16
+        out[i + 1] = c >> 8 & 0xFF
+        out[i + 2] = c & 0xFF
+        out[i + 3] = 255
+
+    r = renderer(path, pixel)
+    gc.collect()
+    t = ticks_us()
+    r.render(0, 0)
+    end = ticks_us()
+    return out, ticks_diff(end, t), ticks_diff(state[1], t), state[0]
+
+
+def heap(path):
+    # peak heap above the start of the decode, bytes allocated (MicroPython
+    # only, counted with gc disabled, '-' if the heap runs out)
+    if tracemalloc:
+        tracemalloc.start()
+        renderer(path, lambda x, y, c: None).render(0, 0)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak, None
+    # sampled at every callback
+    gc.collect()
+    base = gc.mem_alloc()
+    top = [base]
+
+    def sample(x, y, c):
+        m = gc.mem_alloc()
+        if m > top[0]:
+            top[0] = m
+
+    renderer(path, sample).render(0, 0)
+    gc.collect()
+    alloc = None
+    start = gc.mem_alloc()
+    gc.disable()
+    try:
+        renderer(path, lambda x, y, c: None).render(0, 0)
+        alloc = gc.mem_alloc() - start
+    except MemoryError:
+        pass
+    gc.enable()
+    return top[0] - base, alloc
+
+
+def compare(out, ref):
+    # PSNR and max difference of drawn pixels, pixels drawn where nothing is
+    # expected and missing ones, PNG alpha is blended with black
+    se = 0
+    worst = 0
+    n = 0
+    wrong = 0
+    for i in range(0, len(ref), 4):
+        a = ref[i + 3]
+        if not a or not out[i + 3]:
+            if a or out[i + 3]:
+                wrong += 1
+            continue
+        for k in range(3):
+            e = (ref[i + k] * a + 127) // 255 - out[i + k]
+            se += e * e
+            if e < 0:
+                e = -e
+            if e > worst:
+                worst = e
+        n += 3
+    psnr = 99.0
+    if se:
+        from math import log10
+        psnr = min(99.0, 10 * log10(255 * 255 * n / se))
+    return psnr, worst, wrong
+
+
+def kb(v):
+    return '-' if v is None else '%d' % (v // 1024)
+
+
+def main():
+    pattern = sys.argv[1] if len(sys.argv) > 1 else ''
+    names = sorted(f for f in os.listdir(CORPUS) if (f.endswith('.png') or f.endswith('.jpeg')) and pattern in f)
+    if not names:
+        print('no images, run bench/corpus.py first')
+        return
+    # no alloc column on CPython
+    alloc_kb = ' %7s' if not tracemalloc else '%.0s'
+    print(('%-28s %9s %9s %9s %9s %8s %7s' + alloc_kb + ' %6s %4s %5s %s') % (
+        'image', 'size', 'ms', 'ms/MP', 'first ms', 'calls', 'peak kB', 'alloc kB', 'psnr', 'max', 'wrong', ''))
+    failed = 0
+    total = 0
+    for name in names:
+        path = CORPUS + '/' + name
+        with open(path.rsplit('.', 1)[0] + '.rgba', 'rb') as f:
+            ref = f.read()
+        r = renderer(path, None)
+        w, h = r.getMeta()[:2]
+        r = None
+        out, t, first, calls = timed(path, w, h)
+        peak, alloc = heap(path)
+        psnr, worst, wrong = compare(out, ref)
+        ok = not wrong and (worst == 0 if name.endswith('.png') else psnr >= MIN_PSNR)
+        failed += not ok
+        total += t
+        print(('%-28s %9s %9.1f %9.1f %9.1f %8d %7s' + alloc_kb + ' %6.1f %4d %5d %s') % (
+            name, '%dx%d' % (w, h), t / 1000, t * 1000 / (w * h), first / 1000, calls,
+            kb(peak), kb(alloc), psnr, worst, wrong, 'ok' if ok else 'FAIL'))
+        ref = out = None
+        gc.collect()
+    print('%d images, %.1f s, %d failed' % (len(names), total / 1000000, failed))
+    if failed:
+        sys.exit(1)
+
+
+main()
@@ -0,0 +1,617 @@
+# writes the benchmark corpus to bench/corpus (CPython only): PNG files of
+# every color type and bit depth, interlaced and with tRNS, baseline JPEG
+# files of every subsampling mode and progressive JPEG files, at several
+# sizes. Every image has a .rgba file next to it with the expected decoder
+# output, 8-bit R, G, B, A of every pixel (A = 0 for pixels that are not
+# drawn). The images are generated from formulas, so the corpus is the same
+# on every run
+
+import math
+import os
+import struct
+import zlib
+
+DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+SMALL = 61, 53
+MEDIUM = 320, 240
+LARGE = 640, 480
+
+# color type, bit depths
+PNG_TYPES = ((0, (1, 2, 4, 8, 16)), (2, (8, 16)), (3, (1, 2, 4, 8)), (4, (8, 16)), (6, (8, 16)))
+CHANNELS = (1, 0, 3, 1, 2, 0, 4)
+ADAM7 = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+
+# JPEG sampling factors of the luma component, chroma is always 1x1
+SUBSAMPLING = {'444': (1, 1), '422': (2, 1), '420': (2, 2), '440': (1, 2), '411': (4, 1)}
+
+
+def pattern(w, h):
+    # smooth RGBA test image, alpha is 0 in the left eighth, 255 in the right
+    # eighth and a gradient between them
+    px = []
+    for y in range(h):
+        for x in range(w):
+            r = x * 255 // max(1, w - 1)
+            g = y * 255 // max(1, h - 1)
+            b = 128 + int(100 * math.sin(x / 5) * math.cos(y / 7))
+            if x < w // 8:
+                a = 0
+            elif x >= w - w // 8:
+                a = 255
+            else:
+                a = (x - w // 8) * 255 // max(1, w - w // 4)
+            px.append((r, g, b, a))
+    return px
+
+
+# PNG
+
+def palette_colors(n):
+    return [(i * 255 // (n - 1), 255 - i * 255 // (n - 1), i * 97 & 255) for i in range(n)]
+
+
+def png_samples(w, h, color, depth, trns):
+    # samples of every pixel at the bit depth, expected RGBA, PLTE and tRNS
+    src = pattern(w, h)
+    samples = []
+    ref = bytearray(w * h * 4)
+    plte = b''
+    key = b''
+    n = 1 << min(depth, 8)
+    levels = n - 1
+    colors = palette_colors(n) if color == 3 else None
+    if color == 3:
+        plte = b''.join(bytes(c) for c in colors)
+        if trns:
+            key = bytes(i * 255 // levels for i in range(n))
+    for i, (r, g, b, a) in enumerate(src):
+        x = i % w
+        y = i // w
+        if color == 3:
+            v = (x + 2 * y) * n // (w + 2 * h)
+            s = (v,)
+            r, g, b = colors[v]
+            a = key[v] if key else 255
+        elif color in (0, 4):
+            v = (r * 3 + g * 5 + b * 2) // 10
+            if depth < 8:
+                s = (v >> (8 - depth),)
+                v = s[0] * 255 // levels
+            else:
+                s = (v * 257 if depth == 16 else v,)
+            if color == 4:
+                s += (a * 257 if depth == 16 else a,)
+            else:
+                a = 255
+            r = g = b = v
+        else:
+            s = (r, g, b)
+            if color == 6:
+                s += (a,)
+            else:
+                a = 255
+            if depth == 16:
+                s = tuple(c * 257 for c in s)
+        samples.append(s)
+        ref[i * 4:i * 4 + 4] = bytes((r, g, b, a))
+    if trns and color == 0:
+        # color key: the most common gray level
+        k = max(set(samples), key=samples.count)
+        key = struct.pack('>H', k[0])
+        for i, s in enumerate(samples):
+            if s == k:
+                ref[i * 4 + 3] = 0
+    elif trns and color == 2:
+        k = samples[w * h // 2]
+        key = struct.pack('>HHH', *k)
+        for i, s in enumerate(samples):
+            if s == k:
+                ref[i * 4 + 3] = 0
+    return samples, ref, plte, key
+
+
+def pack_row(samples, depth):
+    if depth == 16:
+        return b''.join(struct.pack('>H', v) for s in samples for v in s)
+    if depth == 8:
+        return bytes(v for s in samples for v in s)
+    out = bytearray()
+    acc = 0
+    bits = 0
+    for s in samples:
+        acc = acc << depth | s[0]
+        bits += depth
+        if bits == 8:
+            out.append(acc)
+            acc = 0
+            bits = 0
+    if bits:
+        out.append(acc << (8 - bits))
+    return bytes(out)
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def filter_rows(rows, bpp):
+    # every filter type is used, one after another
+    out = bytearray()
+    prev = bytes(len(rows[0])) if rows else b''
+    for y, row in enumerate(rows):
+        f = y % 5
+        out.append(f)
+        for i, v in enumerate(row):
+            a = row[i - bpp] if i >= bpp else 0
+            b = prev[i]
+            c = prev[i - bpp] if i >= bpp else 0
+            p = (0, a, b, (a + b) >> 1, paeth(a, b, c))[f]
+            out.append((v - p) & 0xFF)
+        prev = row
+    return out
+
+
+def png_file(w, h, color, depth, interlace=False, trns=False):
+    samples, ref, plte, key = png_samples(w, h, color, depth, trns)
+    bpp = max(1, CHANNELS[color] * depth // 8)
+    passes = ADAM7 if interlace else ((0, 0, 1, 1),)
+    raw = bytearray()
+    for x0, y0, dx, dy in passes:
+        rows = [pack_row([samples[y * w + x] for x in range(x0, w, dx)], depth) for y in range(y0, h, dy)]
+        if rows and rows[0]:
+            raw += filter_rows(rows, bpp)
+    data = zlib.compress(bytes(raw), 9)
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    out = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, depth, color, 0, 0, int(interlace)))
+    if plte:
+        out += chunk(b'PLTE', plte)
+    if key:
+        out += chunk(b'tRNS', key)
+    # image data in several IDAT chunks
+    for i in range(0, len(data), 4096):
+        out += chunk(b'IDAT', data[i:i + 4096])
+    return out + chunk(b'IEND', b''), ref
+
+
+# JPEG, baseline with the example tables of the specification, progressive
+# with optimal tables
+
+ZIGZAG = (0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5, 12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+          35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51, 58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63)
+Q_LUMA = (16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55, 14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+          18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92, 49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99)
+Q_CHROMA = (17, 18, 24, 47, 99, 99, 99, 99, 18, 21, 26, 66, 99, 99, 99, 99, 24, 26, 56, 99, 99, 99, 99, 99, 47, 66, 99, 99, 99, 99, 99, 99) + (99,) * 32
+DC_LUMA = (0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0), bytes(range(12))
+DC_CHROMA = (0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0), bytes(range(12))
+AC_LUMA = (0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d), bytes.fromhex(
+    '01020300041105122131410613516107227114328191a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a4344'
+    '45464748494a535455565758595a636465666768696a737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4'
+    'b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9fa')
+AC_CHROMA = (0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77), bytes.fromhex(
+    '000102031104052131061241510761711322328108144291a1b1c109233352f0156272d10a162434e125f11718191a262728292a35363738393a4344'
+    '45464748494a535455565758595a636465666768696a737475767778797a82838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4'
+    'b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8f9fa')
+COS = [[(math.sqrt(0.5) if u == 0 else 1) * math.cos((2 * x + 1) * u * math.pi / 16) / 2 for x in range(8)] for u in range(8)]
+
+
+def huffman_codes(table):
+    counts, values = table
+    codes = {}
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for i in range(counts[length - 1]):
+            codes[values[k]] = code, length
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+
+def fdct(block):
+    # separable forward DCT, rows then columns
+    tmp = [sum(block[y * 8 + x] * COS[u][x] for x in range(8)) for y in range(8) for u in range(8)]
+    return [sum(tmp[y * 8 + u] * COS[v][y] for y in range(8)) for v in range(8) for u in range(8)]
+
+
+class BitWriter():
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def put(self, code, length):
+        self.acc = self.acc << length | code
+        self.bits += length
+        while self.bits >= 8:
+            self.bits -= 8
+            b = self.acc >> self.bits & 0xFF
+            self.out.append(b)
+            if b == 0xFF:
+                self.out.append(0)
+        self.acc &= (1 << self.bits) - 1
+
+    def flush(self):
+        if self.bits:
+            self.put((1 << (8 - self.bits)) - 1, 8 - self.bits)
+
+
+def magnitude(v):
+    if not v:
+        return 0, 0
+    n = abs(v).bit_length()
+    return n, v if v > 0 else v + (1 << n) - 1
+
+
+def huffman_table(freq):
+    # (counts, values) of an optimal table for symbol frequencies, code
+    # lengths limited to 16 bits as in Annex K.2 of the specification
+    symbols = sorted(freq, key=lambda v: -freq[v])
+    # a reserved symbol with the longest code, so no code is all ones
+    symbols.append(256)
+    weights = [freq[v] for v in symbols[:-1]] + [0]
+    depth = [0] * len(symbols)
+    groups = [(weights[i], i, [i]) for i in range(len(symbols))]
+    while len(groups) > 1:
+        groups.sort(key=lambda g: (g[0], -g[1]))
+        a = groups.pop(0)
+        b = groups.pop(0)
+        for i in a[2] + b[2]:
+            depth[i] += 1
+        groups.append((a[0] + b[0], max(a[1], b[1]), a[2] + b[2]))
+    counts = [0] * (max(depth) + 2)
+    for d in depth:
+        counts[d] += 1
+    i = len(counts) - 1
+    while i > 16:
+        while counts[i] > 0:
+            j = i - 2
+            while counts[j] == 0:
+                j -= 1
+            counts[i] -= 2
+            counts[i - 1] += 1
+            counts[j + 1] += 2
+            counts[j] -= 1
+        i -= 1
+    while counts[i] == 0:
+        i -= 1
+    counts[i] -= 1
+    order = sorted(range(len(symbols)), key=lambda k: (depth[k], k))
+    values = bytes(symbols[k] for k in order if symbols[k] != 256)
+    return tuple((counts + [0] * 17)[1:17]), values
+
+
+class ScanWriter():
+    # entropy coder of one scan, the first pass only counts symbols for an
+    # optimal Huffman table of every table number, the second writes bits
+    def __init__(self):
+        self.bits = BitWriter()
+        self.freq = [{}, {}]
+        self.codes = None
+
+    def symbol(self, t, v):
+        if self.codes:
+            self.bits.put(*self.codes[t][v])
+        else:
+            self.freq[t][v] = self.freq[t].get(v, 0) + 1
+
+    def raw(self, value, size):
+        if self.codes and size:
+            self.bits.put(value, size)
+
+    def tables(self):
+        # the written tables, the next pass writes bits
+        tables = [huffman_table(f) if f else None for f in self.freq]
+        self.codes = [huffman_codes(t) if t else None for t in tables]
+        return tables
+
+
+def jpeg_coefficients(w, h, sampling, qt):
+    # quantized coefficients in zigzag order of every block of every
+    # component (blocks of whole MCUs), sampling factors and the expected
+    # pixels
+    gray = sampling == 'gray'
+    src = pattern(w, h)
+    ref = bytearray(w * h * 4)
+    planes = [[], [], []]
+    for i, (r, g, b, a) in enumerate(src):
+        if gray:
+            r = g = b = (r * 3 + g * 5 + b * 2) // 10
+        ref[i * 4:i * 4 + 4] = bytes((r, g, b, 255))
+        planes[0].append(0.299 * r + 0.587 * g + 0.114 * b)
+        planes[1].append(-0.168736 * r - 0.331264 * g + 0.5 * b + 128)
+        planes[2].append(0.5 * r - 0.418688 * g - 0.081312 * b + 128)
+    # id, H, V, table
+    comps = [(1, 1, 1, 0)] if gray else [(1,) + SUBSAMPLING[sampling] + (0,), (2, 1, 1, 1), (3, 1, 1, 1)]
+    hmax = max(c[1] for c in comps)
+    vmax = max(c[2] for c in comps)
+    mcus_x = -(-w // (8 * hmax))
+    mcus_y = -(-h // (8 * vmax))
+
+    def sample(plane, x, y, sx, sy):
+        # average of the sx x sy full resolution samples, edges repeated
+        t = 0.0
+        for j in range(sy):
+            for i in range(sx):
+                t += plane[min(h - 1, y * sy + j) * w + min(w - 1, x * sx + i)]
+        return t / (sx * sy)
+
+    coefs = []
+    for c, (cid, H, V, t) in enumerate(comps):
+        sx = hmax // H
+        sy = vmax // V
+        blocks = {}
+        for by in range(mcus_y * V):
+            for bx in range(mcus_x * H):
+                block = [sample(planes[c], bx * 8 + x, by * 8 + y, sx, sy) - 128 for y in range(8) for x in range(8)]
+                coef = fdct(block)
+                blocks[bx, by] = [int(round(coef[ZIGZAG[k]] / qt[t][ZIGZAG[k]])) for k in range(64)]
+        coefs.append(blocks)
+    return comps, coefs, mcus_x, mcus_y, ref
+
+
+def segment(marker, body):
+    return bytes((0xFF, marker)) + struct.pack('>H', len(body) + 2) + body
+
+
+def jpeg_headers(w, h, comps, qt, sof, dri):
+    out = b'\xff\xd8'
+    out += segment(0xDB, b''.join(bytes([i]) + bytes(qt[i][ZIGZAG[k]] for k in range(64)) for i in range(min(2, len(comps)))))
+    out += segment(sof, struct.pack('>BHHB', 8, h, w, len(comps)) + b''.join(bytes((cid, H << 4 | V, t)) for cid, H, V, t in comps))
+    if dri:
+        out += segment(0xDD, struct.pack('>H', dri))
+    return out
+
+
+def jpeg_file(w, h, sampling='420', quality=90, dri=0):
+    # baseline JPEG, sampling '444' ... '411' or 'gray'
+    s = 5000 // quality if quality < 50 else 200 - 2 * quality
+    qt = [[min(255, max(1, (v * s + 50) // 100)) for v in q] for q in (Q_LUMA, Q_CHROMA)]
+    comps, coefs, mcus_x, mcus_y, ref = jpeg_coefficients(w, h, sampling, qt)
+    dc = huffman_codes(DC_LUMA), huffman_codes(DC_CHROMA)
+    ac = huffman_codes(AC_LUMA), huffman_codes(AC_CHROMA)
+    bits = BitWriter()
+    pred = [0, 0, 0]
+    n = 0
+    rst = 0
+    for my in range(mcus_y):
+        for mx in range(mcus_x):
+            if dri and n and not n % dri:
+                bits.flush()
+                bits.out += bytes((0xFF, 0xD0 + rst))
+                rst = (rst + 1) & 7
+                pred = [0, 0, 0]
+            n += 1
+            for c, (cid, H, V, t) in enumerate(comps):
+                for v in range(V):
+                    for u in range(H):
+                        zz = coefs[c][mx * H + u, my * V + v]
+                        size, value = magnitude(zz[0] - pred[c])
+                        pred[c] = zz[0]
+                        bits.put(*dc[t][size])
+                        if size:
+                            bits.put(value, size)
+                        run = 0
+                        for k in range(1, 64):
+                            if not zz[k]:
+                                run += 1
+                                continue
+                            while run > 15:
+                                bits.put(*ac[t][0xF0])
+                                run -= 16
+                            size, value = magnitude(zz[k])
+                            bits.put(*ac[t][run << 4 | size])
+                            bits.put(value, size)
+                            run = 0
+                        if run:
+                            bits.put(*ac[t][0])
+    bits.flush()
+    out = jpeg_headers(w, h, comps, qt, 0xC0, dri)
+    for kind, i, table in ((0, 0, DC_LUMA), (1, 0, AC_LUMA), (0, 1, DC_CHROMA), (1, 1, AC_CHROMA)):
+        if i < min(2, len(comps)):
+            out += segment(0xC4, bytes((kind << 4 | i,)) + bytes(table[0]) + bytes(table[1]))
+    out += segment(0xDA, bytes((len(comps),)) + b''.join(bytes((cid, t << 4 | t)) for cid, H, V, t in comps) + bytes((0, 63, 0)))
+    return out + bits.out + b'\xff\xd9', ref
+
+
+# progressive scans like the default script of libjpeg: component numbers,
+# Ss, Se, Ah, Al
+SCANS = (((0, 1, 2), 0, 0, 0, 1), ((0,), 1, 5, 0, 2), ((2,), 1, 63, 0, 1), ((1,), 1, 63, 0, 1), ((0,), 6, 63, 0, 2),
+         ((0,), 1, 63, 2, 1), ((0, 1, 2), 0, 0, 1, 0), ((2,), 1, 63, 1, 0), ((1,), 1, 63, 1, 0), ((0,), 1, 63, 1, 0))
+
+
+def progressive_scan(out, comps, coefs, mcus_x, mcus_y, w, h, scan, dri):
+    # codes one scan (spectral selection with successive approximation,
+    # EOB runs, correction bits of refinement scans, restart intervals)
+    cs, ss, se, ah, al = scan
+    hmax = max(c[1] for c in comps)
+    vmax = max(c[2] for c in comps)
+    pred = [0, 0, 0]
+    state = {'eobrun': 0, 'bits': []}
+
+    def flush_eobrun(t):
+        # pending EOB run with the correction bits of its blocks
+        e = state['eobrun']
+        if e:
+            n = e.bit_length() - 1
+            out.symbol(t, n << 4)
+            out.raw(e & ((1 << n) - 1), n)
+            for b in state['bits']:
+                out.raw(b, 1)
+            state['eobrun'] = 0
+            state['bits'] = []
+
+    def ac_first(zz, t):
+        run = 0
+        for k in range(ss, se + 1):
+            v = zz[k]
+            v = v >> al if v >= 0 else -(-v >> al)
+            if not v:
+                run += 1
+                continue
+            flush_eobrun(t)
+            while run > 15:
+                out.symbol(t, 0xF0)
+                run -= 16
+            size, value = magnitude(v)
+            out.symbol(t, run << 4 | size)
+            out.raw(value, size)
+            run = 0
+        if run:
+            state['eobrun'] += 1
+            if state['eobrun'] == 0x7FFF:
+                flush_eobrun(t)
+
+    def ac_refine(zz, t):
+        absolute = [abs(zz[k]) >> al for k in range(64)]
+        last = 0  # last coefficient that becomes nonzero in this scan
+        for k in range(ss, se + 1):
+            if absolute[k] == 1:
+                last = k
+        run = 0
+        pending = []
+        for k in range(ss, se + 1):
+            v = absolute[k]
+            if not v:
+                run += 1
+                continue
+            while run > 15 and k <= last:
+                flush_eobrun(t)
+                out.symbol(t, 0xF0)
+                run -= 16
+                for b in pending:
+                    out.raw(b, 1)
+                pending = []
+            if v > 1:
+                # correction bit of a coefficient nonzero before
+                pending.append(v & 1)
+                continue
+            flush_eobrun(t)
+            out.symbol(t, run << 4 | 1)
+            out.raw(1 if zz[k] > 0 else 0, 1)
+            for b in pending:
+                out.raw(b, 1)
+            pending = []
+            run = 0
+        if run or pending:
+            state['eobrun'] += 1
+            state['bits'] += pending
+            if state['eobrun'] == 0x7FFF or len(state['bits']) > 937:
+                flush_eobrun(t)
+
+    def code(c, zz):
+        t = comps[c][3]
+        if ss == 0:
+            if ah:
+                out.raw(zz[0] >> al & 1, 1)
+                return
+            v = zz[0] >> al
+            size, value = magnitude(v - pred[c])
+            pred[c] = v
+            out.symbol(t, size)
+            out.raw(value, size)
+        elif ah:
+            ac_refine(zz, t)
+        else:
+            ac_first(zz, t)
+
+    # interleaved scans code MCUs, single component scans the blocks of
+    # the component inside the image
+    if len(cs) > 1:
+        units = [[(c, (mx * comps[c][1] + u, my * comps[c][2] + v)) for c in cs
+                  for v in range(comps[c][2]) for u in range(comps[c][1])]
+                 for my in range(mcus_y) for mx in range(mcus_x)]
+    else:
+        c = cs[0]
+        bw = -(-(-(-w * comps[c][1] // hmax)) // 8)
+        bh = -(-(-(-h * comps[c][2] // vmax)) // 8)
+        units = [[(c, (bx, by))] for by in range(bh) for bx in range(bw)]
+    t = comps[cs[0]][3]
+    rst = 0
+    for n, unit in enumerate(units):
+        if dri and n and not n % dri:
+            flush_eobrun(t)
+            if out.codes:
+                out.bits.flush()
+                out.bits.out += bytes((0xFF, 0xD0 + rst))
+            rst = (rst + 1) & 7
+            pred = [0, 0, 0]
+        for c, b in unit:
+            code(c, coefs[c][b])
+    flush_eobrun(t)
+
+
+def progressive_file(w, h, sampling='420', quality=90, dri=0):
+    # progressive JPEG with the scans of SCANS and optimal Huffman tables
+    s = 5000 // quality if quality < 50 else 200 - 2 * quality
+    qt = [[min(255, max(1, (v * s + 50) // 100)) for v in q] for q in (Q_LUMA, Q_CHROMA)]
+    comps, coefs, mcus_x, mcus_y, ref = jpeg_coefficients(w, h, sampling, qt)
+    out = jpeg_headers(w, h, comps, qt, 0xC2, dri)
+    for scan in SCANS:
+        cs, ss, se, ah, al = scan
+        coder = ScanWriter()
+        progressive_scan(coder, comps, coefs, mcus_x, mcus_y, w, h, scan, dri)
+        tables = coder.tables()
+        progressive_scan(coder, comps, coefs, mcus_x, mcus_y, w, h, scan, dri)
+        coder.bits.flush()
+        for i, table in enumerate(tables):
+            if table:
+                out += segment(0xC4, bytes(((ss > 0) << 4 | i,)) + bytes(table[0]) + table[1])
+        # DC and AC tables of a component have the number of its table
+        out += segment(0xDA, bytes((len(cs),)) + b''.join(bytes((comps[c][0], comps[c][3] * 17)) for c in cs) + bytes((ss, se, ah << 4 | al)))
+        out += coder.bits.out
+    return out + b'\xff\xd9', ref
+
+
+def images():
+    # name, function, arguments
+    w, h = SMALL
+    for color, depths in PNG_TYPES:
+        for depth in depths:
+            name = 'png-c%dd%d-%dx%d' % (color, depth, w, h)
+            yield name, png_file, (w, h, color, depth)
+            yield name + '-i', png_file, (w, h, color, depth, True)
+    for color in (0, 2, 3):
+        yield 'png-c%dd8-%dx%d-t' % (color, w, h), png_file, (w, h, color, 8, False, True)
+    for w, h in (MEDIUM, LARGE):
+        for color in (2, 3, 6):
+            yield 'png-c%dd8-%dx%d' % (color, w, h), png_file, (w, h, color, 8)
+    w, h = SMALL
+    for sampling in ('gray', '444', '422', '420', '440', '411'):
+        yield 'jpeg-%s-%dx%d' % (sampling, w, h), jpeg_file, (w, h, sampling)
+    for sampling in ('444', '422', '420'):
+        yield 'jpeg-%s-%dx%d' % (sampling, MEDIUM[0], MEDIUM[1]), jpeg_file, MEDIUM + (sampling,)
+    yield 'jpeg-420-%dx%d' % LARGE, jpeg_file, LARGE + ('420',)
+    yield 'jpeg-420-%dx%d-dri' % LARGE, jpeg_file, LARGE + ('420', 90, 4)
+    yield 'jpeg-420-%dx%d-p' % SMALL, progressive_file, SMALL + ('420',)
+    yield 'jpeg-420-%dx%d-p' % MEDIUM, progressive_file, MEDIUM + ('420',)
+    yield 'jpeg-444-%dx%d-p-dri' % MEDIUM, progressive_file, MEDIUM + ('444', 90, 5)
+
+
+def main():
+    if not os.path.isdir(DIR):
+        os.mkdir(DIR)
+    for name, make, args in images():
+        ext = '.png' if make is png_file else '.jpeg'
+        if os.path.exists(os.path.join(DIR, name + ext)):
+            continue
+        data, ref = make(*args)
+        with open(os.path.join(DIR, name + ext), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(DIR, name + '.rgba'), 'wb') as f:
+            f.write(ref)
+        print(name, len(data))
+
+
+if __name__ == '__main__':
+    main()
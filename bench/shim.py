@@ -0,0 +1,29 @@
+# runs the decoders on CPython: micropython decorators do nothing, viper
+# pointers are the buffers themselves (indexing bytearray, array and
+# memoryview objects works the same way) and viper casts are plain ints
+
+import builtins
+import sys
+
+
+class micropython:
+    @staticmethod
+    def native(f):
+        return f
+
+    viper = native
+
+    @staticmethod
+    def const(x):
+        return x
+
+
+def ptr(buf):
+    return buf
+
+
+sys.modules['micropython'] = micropython
+builtins.micropython = micropython
+builtins.const = micropython.const
+builtins.ptr8 = builtins.ptr16 = builtins.ptr32 = ptr
+builtins.uint = int
@@ -0,0 +1,107 @@
+# batch decoding of many PNG/JPEG images on a process or thread pool, for
+# CPython hosts with the micropython decorators shimmed (not for boards),
+# every image is decoded into an imgcache.CachedImage with rows of output
+# pixels
+
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import PNGdecoder
+import JPEGdecoder
+from imgcache import CachedImage
+from PNGdecoder import RGB888
+
+# decoder contexts of the current worker thread or process
+local = threading.local()
+
+
+def probe(source):
+    # probe result of PNGdecoder or JPEGdecoder, whichever accepts the source
+    try:
+        return PNGdecoder.probe(source)
+    except ValueError:
+        return JPEGdecoder.probe(source)
+
+
+def meta(source, jpeg_options=None):
+    # format and output width and height of the source
+    info = probe(source)
+    scale = (jpeg_options or {}).get('scale', 1) if info['format'] == 'jpeg' else 1
+    return info['format'], -(-info['width'] // scale), -(-info['height'] // scale)
+
+
+def decoder(fmt, output_format, options):
+    # one reused decoder context per format and options in every worker
+    contexts = getattr(local, 'contexts', None)
+    if contexts is None:
+        contexts = local.contexts = {}
+    k = fmt, output_format, tuple(sorted(options.items()))
+    if k not in contexts:
+        context = PNGdecoder.PNGDecoder if fmt == 'png' else JPEGdecoder.JPEGDecoder
+        contexts[k] = context(blockcallback=print, output_format=output_format, **options)
+    return contexts[k]
+
+
+def decode(source, output_format=RGB888, png_options=None, jpeg_options=None):
+    fmt, W, H = meta(source, jpeg_options)
+    options = (png_options if fmt == 'png' else jpeg_options) or {}
+    img = CachedImage(W, H, (3, 2, 2, 1, 1)[output_format])
+    data = img.data
+    n = img.pxsize
+
+    def blit(x, y, w, h, buf):
+        size = w * n
+        for j in range(h):
+            i = ((y + j) * W + x) * n
+            data[i:i + size] = buf[j * size:(j + 1) * size]
+
+    decoder(fmt, output_format, options).decode(source, blit)
+    return img
+
+
+def size(source, output_format, jpeg_options):
+    # bytes of the decoded image, 0 if the headers can't be read
+    try:
+        fmt, W, H = meta(source, jpeg_options)
+    except (OSError, ValueError):
+        return 0
+    return W * H * (3, 2, 2, 1, 1)[output_format]
+
+
+def decode_many(sources, workers=4, processes=True, pending=0, max_bytes=0, initializer=None,
+                output_format=RGB888, png_options=None, jpeg_options=None):
+    # generator, yields (source, image) in completion order, image is an
+    # imgcache.CachedImage or the exception raised while decoding the source
+    pending = pending or 2 * workers
+    pool = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers, initializer=initializer)
+    sources = iter(sources)
+    running = {}  # future: (source, bytes)
+    used = 0
+    source = None
+    need = 0
+    left = True
+    try:
+        while True:
+            while left and len(running) < pending:
+                if source is None:
+                    source = next(sources, None)
+                    if source is None:
+                        left = False
+                        break
+                    need = size(source, output_format, jpeg_options) if max_bytes else 0
+                # one image is always decoded, even if it is over the limit
+                if running and used + need > max_bytes > 0:
+                    break
+                f = pool.submit(decode, source, output_format, png_options, jpeg_options)
+                running[f] = source, need
+                used += need
+                source = None
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                src, n = running.pop(f)
+                used -= n
+                error = f.exception()
+                yield src, error if error else f.result()
+    finally:
+        pool.shutdown(cancel_futures=True)
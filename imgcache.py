@@ -0,0 +1,196 @@
+# shared cache of decoded images for PNG and JPEG renderers created with
+# cache=True, images are stored in their output pixel format and the least
+# recently used ones are dropped when the byte budget is exceeded. Also the
+# crop view and incremental rendering shared by both renderers
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+budget = 32 * 1024
+used = 0
+images = {}
+lru = []  # keys, least recently used first
+
+
+class CachedImage():
+    def __init__(self, w, h, pxsize, transparent=False):
+        self.w = w
+        self.h = h
+        self.pxsize = pxsize
+        # w * h pixels in rows, big-endian bytes of output color values,
+        # the blockcallback buffer format
+        self.data = bytearray(w * h * pxsize)
+        # bit per pixel, set for transparent pixels, their data is bg color
+        self.mask = bytearray((w * h + 7) // 8) if transparent else None
+
+    def size(self):
+        return len(self.data) + (len(self.mask) if self.mask else 0)
+
+
+def key(source, *params):
+    # None if source can't be used as a key (e.g. mutable buffers or open
+    # files), buffers are keys themselves so equal hashes are told apart by
+    # their contents
+    if isinstance(source, str):
+        return (source,) + params
+    try:
+        len(source)
+        hash(source)
+    except (TypeError, ValueError):
+        return None
+    return (source,) + params
+
+
+def set_budget(size):
+    global budget
+    budget = size
+    evict(0)
+
+
+def evict(size):
+    # drops least recently used images until size more bytes fit the budget
+    global used
+    while lru and used + size > budget:
+        used -= images.pop(lru.pop(0)).size()
+
+
+def clear():
+    evict(budget + 1)
+
+
+def new(w, h, pxsize, transparent=False):
+    # frees space for a new image, None if it is larger than the budget
+    size = w * h * pxsize + ((w * h + 7) // 8 if transparent else 0)
+    if not w or not h or size > budget:
+        return None
+    evict(size)
+    return CachedImage(w, h, pxsize, transparent)
+
+
+def get(k):
+    img = images.get(k)
+    if img:
+        lru.remove(k)
+        lru.append(k)
+    return img
+
+
+def put(k, img):
+    global used
+    if k is None or img is None:
+        return
+    if k in images:
+        used -= images.pop(k).size()
+        lru.remove(k)
+    evict(img.size())
+    images[k] = img
+    lru.append(k)
+    used += img.size()
+
+
+def show(img, x, y, callback, blockcallback):
+    if blockcallback:
+        # the whole image in one call
+        blockcallback(x, y, img.w, img.h, img.data)
+    elif img.mask:
+        showMasked(img, x, y, callback)
+    else:
+        showPixels(img, x, y, callback)
+
+
+@micropython.viper
+def showPixels(img, x: int, y: int, callback):
+    p = ptr8(img.data)
+    n = int(img.pxsize)
+    w = int(img.w)
+    h = int(img.h)
+    i = 0
+    for py in range(y, y + h):
+        for px in range(x, x + w):
+            c = 0
+            for k in range(n):
+                c = (c << 8) | p[i]
+                i += 1
+            callback(px, py, c)
+
+
+@micropython.viper
+def showMasked(img, x: int, y: int, callback):
+    p = ptr8(img.data)
+    m = ptr8(img.mask)
+    n = int(img.pxsize)
+    w = int(img.w)
+    h = int(img.h)
+    i = 0
+    j = 0
+    for py in range(y, y + h):
+        for px in range(x, x + w):
+            if m[j >> 3] & (1 << (j & 7)):
+                i += n
+            else:
+                c = 0
+                for k in range(n):
+                    c = (c << 8) | p[i]
+                    i += 1
+                callback(px, py, c)
+            j += 1
+
+
+def view(crop, W, H):
+    # visible part of the image and the image coordinates drawn at the
+    # render position (may lie outside of the image)
+    if not crop:
+        return 0, 0, W, H, 0, 0
+    x, y, w, h = crop
+    x0 = max(0, min(x, W))
+    y0 = max(0, min(y, H))
+    return x0, y0, max(0, min(x + w, W) - x0), max(0, min(y + h, H) - y0), x, y
+
+
+def region(view, rx, ry, top, bottom):
+    # screen rectangle of image rows top..bottom clipped to the view,
+    # None if nothing of it is visible
+    cx, cy, cw, ch, ox, oy = view
+    top = max(top, cy)
+    bottom = min(bottom, cy + ch)
+    if top >= bottom or not cw:
+        return None
+    return rx + cx - ox, ry + top - oy, cw, bottom - top
+
+
+class Steps():
+    # start, step and renderAsync of renderers with a renderSteps generator
+
+    def start(self, x=0, y=0, **kwargs):
+        # incremental render continued by step(), takes renderSteps arguments
+        self.steps = self.renderSteps(x, y, **kwargs)
+        return self
+
+    def step(self, budget_ms=10):
+        # decodes for about budget_ms, returns False once the image is done
+        if self.steps is None:
+            return False
+        t = ticks_ms()
+        for r in self.steps:
+            if ticks_diff(ticks_ms(), t) >= budget_ms:
+                return True
+        self.steps = None
+        return False
+
+    async def renderAsync(self, x=0, y=0, **kwargs):
+        # render for asyncio, other tasks run between steps
+        try:
+            import asyncio
+        except ImportError:
+            import uasyncio as asyncio
+        for r in self.renderSteps(x, y, **kwargs):
+            await asyncio.sleep(0)
+        return self
@@ -0,0 +1,166 @@
+# per-stage profiling of PNG and JPEG renderers created with profile=Profile(),
+# decoder functions of every stage are wrapped when the renderer is created,
+# renderers without profile run the unwrapped functions
+
+import gc
+from io import IOBase
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# fields of stage stats
+CALLS = 0
+TIME = 1  # microseconds
+READ = 2  # bytes read from the source file
+ALLOC = 3  # bytes allocated
+FREE = 4  # lowest free heap after a call
+
+
+def allocated():
+    # bytes allocated so far, None if the port can't tell
+    if hasattr(gc, 'mem_alloc'):
+        return gc.mem_alloc()
+    if tracemalloc and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return None
+
+
+def free():
+    return gc.mem_free() if hasattr(gc, 'mem_free') else None
+
+
+class Reader(IOBase):
+    # file wrapper counting bytes read, the time spent reading is the io
+    # stage (it is also part of the stage that reads)
+    def __init__(self, profile, file):
+        self.profile = profile
+        self.file = file
+
+    def read(self, n=-1):
+        t = ticks_us()
+        data = self.file.read(n)
+        self.profile.count(len(data), ticks_diff(ticks_us(), t))
+        return data
+
+    def readinto(self, buf):
+        t = ticks_us()
+        n = self.file.readinto(buf)
+        self.profile.count(n or 0, ticks_diff(ticks_us(), t))
+        return n
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        return self.file.close()
+
+
+class Profile():
+    def __init__(self):
+        # stage: [calls, us, bytes read, bytes allocated, lowest free heap]
+        self.image = {}
+        self.total = {}
+        self.stages = []  # names in the order of first use
+        self.source = None
+        self.time = 0
+        self.total_time = 0
+        self.images = 0
+        self.read = 0
+        self.started = 0
+
+    def stage(self, name):
+        if name not in self.image:
+            self.image[name] = [0, 0, 0, 0, None]
+            self.total[name] = [0, 0, 0, 0, None]
+            self.stages.append(name)
+        return self.image[name]
+
+    def wrap(self, name, f):
+        # f with its calls recorded as stage name
+        s = self.stage(name)
+
+        def profiled(*args):
+            a = allocated()
+            n = self.read
+            t = ticks_us()
+            r = f(*args)
+            s[TIME] += ticks_diff(ticks_us(), t)
+            s[CALLS] += 1
+            s[READ] += self.read - n
+            if a is not None:
+                a = allocated() - a
+                # negative if gc ran during the call
+                if a > 0:
+                    s[ALLOC] += a
+                m = free()
+                if m is not None and (s[FREE] is None or m < s[FREE]):
+                    s[FREE] = m
+            return r
+        return profiled
+
+    def reader(self, file):
+        self.stage('io')
+        return Reader(self, file)
+
+    def count(self, n, us):
+        self.read += n
+        s = self.image['io']
+        s[CALLS] += 1
+        s[TIME] += us
+        s[READ] += n
+
+    def start(self, source):
+        # called by the renderer when an image starts
+        # a short label, buffer sources are not kept or printed
+        if isinstance(source, str):
+            self.source = source
+        elif hasattr(source, 'readinto'):
+            self.source = '<file>'
+        else:
+            self.source = '<buffer %d bytes>' % len(source)
+        for s in self.image.values():
+            for i in range(FREE):
+                s[i] = 0
+            s[FREE] = None
+        self.started = ticks_us()
+
+    def end(self):
+        # called by the renderer when an image is done, adds its stats to
+        # the totals
+        self.time = ticks_diff(ticks_us(), self.started)
+        self.total_time += self.time
+        self.images += 1
+        for name, s in self.image.items():
+            t = self.total[name]
+            for i in range(FREE):
+                t[i] += s[i]
+            if s[FREE] is not None and (t[FREE] is None or s[FREE] < t[FREE]):
+                t[FREE] = s[FREE]
+
+    def report(self, total=False):
+        stats = self.total if total else self.image
+        if total:
+            print('%d images, %.1f ms' % (self.images, self.total_time / 1000))
+        else:
+            print('%s, %.1f ms' % (self.source, self.time / 1000))
+        print('%-10s %8s %10s %6s %10s %10s %10s' % ('stage', 'calls', 'ms', '%', 'read', 'alloc', 'free'))
+        time = self.total_time if total else self.time
+        for name in self.stages:
+            s = stats[name]
+            print('%-10s %8d %10.1f %6.1f %10d %10d %10s' % (
+                name, s[CALLS], s[TIME] / 1000, 100 * s[TIME] / max(1, time), s[READ], s[ALLOC],
+                '-' if s[FREE] is None else s[FREE]))